@@ -0,0 +1,118 @@
+import hashlib
+import io
+import os
+import threading
+
+from spotify_client import get_http_session
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it the closest Spotify size is served as is
+    Image = None
+
+# Folder for cached cover art thumbnails
+ART_CACHE_DIR = '.art_cache'
+
+# Upper bound for the cache folder (bytes); least recently used files are removed first
+ART_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+THUMBNAIL_SIZES = (150, 300)
+
+FETCH_TIMEOUT = 10  # seconds
+
+PLACEHOLDER_SVG = b"""<svg xmlns="http://www.w3.org/2000/svg" width="300" height="300" viewBox="0 0 300 300">
+<rect width="300" height="300" fill="#ddd"/>
+<circle cx="150" cy="150" r="60" fill="none" stroke="#999" stroke-width="12"/>
+<circle cx="150" cy="150" r="12" fill="#999"/>
+</svg>"""
+
+
+def pick_image(images, size):
+    """The smallest Spotify image at least `size` pixels wide (or the largest there is)."""
+    if not images:
+        return None
+    by_width = sorted(images, key=lambda image: image.get('width') or 0)
+    for image in by_width:
+        if (image.get('width') or 0) >= size:
+            return image
+    return by_width[-1]
+
+
+class ArtCache:
+    """Content-addressed disk cache of cover art thumbnails with a size cap and LRU eviction."""
+
+    def __init__(self, directory=ART_CACHE_DIR, max_bytes=ART_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url, size):
+        digest = hashlib.sha256(f"{url}@{size}".encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.jpg')
+
+    def thumbnail(self, images, size):
+        """Path to a `size` px thumbnail of the cover described by `images`, or None if there is none."""
+        image = pick_image(images, size)
+        if image is None:
+            return None
+        path = self._path(image['url'], size)
+        if os.path.exists(path):
+            os.utime(path)  # Mark as recently used
+            return path
+
+        data = self._fetch(image['url'])
+        if Image is not None and (image.get('width') or size + 1) > size:
+            data = self._resize(data, size)
+        self._store(path, data)
+        return path
+
+    @staticmethod
+    def _fetch(url):
+        response = get_http_session().get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    @staticmethod
+    def _resize(data, size):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85, optimize=True)
+        return output.getvalue()
+
+    def _store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.jpg'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # Drop the least recently used files until we're at 90% of the cap
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            self._total_bytes -= size
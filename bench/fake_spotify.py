@@ -0,0 +1,330 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEVICE_ID = 'bench-device'
+USER_ID = 'bench-user'
+
+# Average track length of the generated playlists (seconds)
+TRACK_SECONDS = 210
+
+
+def spotify_id(kind, n):
+    """A 22-character id, like Spotify's base62 ones."""
+    return f'{kind[0]}{n:021d}'
+
+
+class Faults:
+    """Latency and error injection for the fake API."""
+
+    def __init__(self, latency_ms=80, jitter_ms=40, error_403=0.0, error_429=0.0, retry_after=1, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_403 = error_403  # Share of player commands answered with a transient 403
+        self.error_429 = error_429  # Share of all requests answered with 429
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            return max(self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms), 0) / 1000
+
+    def roll(self, probability):
+        with self._lock:
+            return self._random.random() < probability
+
+
+class FakePlayer:
+    """One device's playback, advanced lazily on the (simulated) clock."""
+
+    def __init__(self, library, clock, seed=0):
+        self.library = library
+        self.clock = clock
+        self.shuffle = False
+        self.queue = []  # Track dicts
+        self.context_uri = None
+        self.index = 0
+        self.playing = False
+        self._progress_ms = 0.0
+        self._anchor = clock()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _advance(self):
+        now = self.clock()
+        if self.playing and self.queue:
+            self._progress_ms += (now - self._anchor) * 1000
+            while self._progress_ms >= self.queue[self.index]['duration_ms']:
+                self._progress_ms -= self.queue[self.index]['duration_ms']
+                if self.index + 1 >= len(self.queue):
+                    self.playing = False
+                    self._progress_ms = 0
+                    break
+                self.index += 1
+        self._anchor = now
+
+    def state(self):
+        with self._lock:
+            self._advance()
+            if not self.queue:
+                return None
+            return {
+                'device': {'id': DEVICE_ID, 'name': 'Bench', 'is_active': True},
+                'shuffle_state': self.shuffle,
+                'context': {'uri': self.context_uri} if self.context_uri else None,
+                'progress_ms': int(self._progress_ms),
+                'is_playing': self.playing,
+                'item': self.queue[self.index],
+                'currently_playing_type': 'track',
+            }
+
+    def remaining_ms(self):
+        """Time actually left in the current track; what the pre-end trigger is aiming for."""
+        with self._lock:
+            self._advance()
+            if not self.playing or not self.queue:
+                return None
+            return self.queue[self.index]['duration_ms'] - self._progress_ms
+
+    def play(self, body):
+        with self._lock:
+            self._advance()
+            if body.get('context_uri'):
+                tracks = list(self.library.tracks(body['context_uri']))
+                index = 0
+                offset = body.get('offset') or {}
+                if 'position' in offset:
+                    index = offset['position']
+                elif 'uri' in offset:
+                    index = next((i for i, track in enumerate(tracks) if track['uri'] == offset['uri']), 0)
+                first = tracks[index] if tracks else None
+                if self.shuffle:
+                    self._random.shuffle(tracks)
+                    if first is not None:
+                        tracks.remove(first)
+                        tracks.insert(0, first)
+                    index = 0
+                self.queue, self.context_uri, self.index = tracks, body['context_uri'], index
+                self._progress_ms = body.get('position_ms') or 0
+            elif body.get('uris'):
+                self.queue = [self.library.track(uri) for uri in body['uris']]
+                self.context_uri, self.index = None, 0
+                self._progress_ms = body.get('position_ms') or 0
+            self.playing = bool(self.queue)
+
+    def pause(self):
+        with self._lock:
+            self._advance()
+            self.playing = False
+
+    def seek(self, position_ms):
+        with self._lock:
+            self._advance()
+            self._progress_ms = position_ms
+
+
+class FakeLibrary:
+    """Playlists of arbitrary size with deterministic tracks."""
+
+    def __init__(self, playlists=8, tracks_per_playlist=200, seed=0):
+        rng = random.Random(seed)
+        self._tracks = {}
+        self.playlists = []
+        for p in range(playlists):
+            playlist_id = spotify_id('playlist', p)
+            uris = []
+            for t in range(tracks_per_playlist):
+                track_id = spotify_id('track', p * tracks_per_playlist + t)
+                uri = f'spotify:track:{track_id}'
+                self._tracks[uri] = {'uri': uri, 'id': track_id, 'name': f'Track {p}-{t}',
+                                     'duration_ms': int(rng.uniform(0.5, 1.5) * TRACK_SECONDS * 1000)}
+                uris.append(uri)
+            self.playlists.append({'id': playlist_id, 'uri': f'spotify:playlist:{playlist_id}',
+                                   'name': f'Bench playlist {p}', 'snapshot_id': f'snap-{p}', 'tracks': uris})
+        self._by_id = {playlist['id']: playlist for playlist in self.playlists}
+
+    def playlist(self, playlist_id):
+        return self._by_id.get(playlist_id)
+
+    def tracks(self, context_uri):
+        playlist = self._by_id.get(context_uri.rsplit(':', 1)[-1])
+        return [self._tracks[uri] for uri in playlist['tracks']] if playlist else []
+
+    def track(self, uri):
+        return self._tracks[uri]
+
+
+class FakeSpotify:
+    """A local stand-in for the parts of the Spotify Web API the radio and the panel use.
+
+    Serves on 127.0.0.1 from a background thread; point spotipy at `prefix`. Playback
+    runs on `clock` (the bench's simulated clock). Every request is counted by
+    endpoint in `calls`, and every one answered with a 404 by method and path in
+    `not_found`, so the bench can tell when the radio uses a call the fake lacks.
+    """
+
+    ROUTES = [
+        ('GET', r'/v1/me/player', 'current_playback'),
+        ('GET', r'/v1/me/player/devices', 'devices'),
+        ('PUT', r'/v1/me/player/play', 'start_playback'),
+        ('PUT', r'/v1/me/player/pause', 'pause_playback'),
+        ('PUT', r'/v1/me/player/shuffle', 'shuffle'),
+        ('PUT', r'/v1/me/player/seek', 'seek_track'),
+        ('GET', r'/v1/me', 'current_user'),
+        ('GET', r'/v1/me/playlists', 'current_user_playlists'),
+        ('GET', r'/v1/users/[^/]+/playlists', 'current_user_playlists'),
+        ('GET', r'/v1/playlists/(?P<id>[^/]+)', 'playlist'),
+        ('GET', r'/v1/playlists/(?P<id>[^/]+)/tracks', 'playlist_items'),
+        ('GET', r'/v1/playlists/(?P<id>[^/]+)/items', 'playlist_items'),  # spotipy >= 2.26
+    ]
+
+    def __init__(self, library, faults=None, clock=time.monotonic):
+        self.library = library
+        self.faults = faults or Faults()
+        self.player = FakePlayer(library, clock)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.not_found = Counter()
+        self._routes = [(method, re.compile(pattern + r'/?$'), name) for method, pattern, name in self.ROUTES]
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def prefix(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/v1/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Endpoints
+
+    def handle(self, method, path, query, body):
+        """Returns (status, payload, headers)."""
+        status, payload, headers = self._route(method, path, query, body)
+        if status == 404:
+            self.not_found[method, path] += 1
+        return status, payload, headers
+
+    def _route(self, method, path, query, body):
+        for route_method, pattern, name in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}, {}
+
+        self.calls[name] += 1
+        time.sleep(self.faults.delay())
+        if self.faults.roll(self.faults.error_429):
+            self.errors[name, 429] += 1
+            return 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, \
+                {'Retry-After': str(self.faults.retry_after)}
+        if method == 'PUT' and self.faults.roll(self.faults.error_403):
+            self.errors[name, 403] += 1
+            return 403, {'error': {'status': 403, 'message': 'Player command failed'}}, {}
+        return getattr(self, '_' + name)(query, body, **match.groupdict())
+
+    def _current_playback(self, query, body):
+        state = self.player.state()
+        return (200, state, {}) if state else (204, None, {})
+
+    def _devices(self, query, body):
+        return 200, {'devices': [{'id': DEVICE_ID, 'name': 'Bench', 'is_active': True, 'type': 'Computer'}]}, {}
+
+    def _start_playback(self, query, body):
+        self.player.play(body or {})
+        return 204, None, {}
+
+    def _pause_playback(self, query, body):
+        self.player.pause()
+        return 204, None, {}
+
+    def _shuffle(self, query, body):
+        self.player.shuffle = query.get('state') == 'true'
+        return 204, None, {}
+
+    def _seek_track(self, query, body):
+        self.player.seek(int(query.get('position_ms', 0)))
+        return 204, None, {}
+
+    def _current_user(self, query, body):
+        return 200, {'id': USER_ID, 'display_name': 'Bench'}, {}
+
+    def _current_user_playlists(self, query, body):
+        limit, offset = int(query.get('limit', 50)), int(query.get('offset', 0))
+        page = self.library.playlists[offset:offset + limit]
+        has_next = offset + limit < len(self.library.playlists)
+        return 200, {
+            'items': [self._playlist_summary(playlist) for playlist in page],
+            'limit': limit, 'offset': offset, 'total': len(self.library.playlists),
+            'next': f'{self.prefix}me/playlists?offset={offset + limit}&limit={limit}' if has_next else None,
+        }, {}
+
+    def _playlist(self, query, body, id):
+        playlist = self.library.playlist(id)
+        if playlist is None:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}, {}
+        return 200, self._playlist_summary(playlist), {}
+
+    def _playlist_items(self, query, body, id):
+        playlist = self.library.playlist(id)
+        if playlist is None:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}, {}
+        limit, offset = int(query.get('limit', 100)), int(query.get('offset', 0))
+        uris = playlist['tracks'][offset:offset + limit]
+        has_next = offset + limit < len(playlist['tracks'])
+        return 200, {
+            'items': [{'track': self.library.track(uri)} for uri in uris],
+            'next': f'{self.prefix}playlists/{id}/items?offset={offset + limit}&limit={limit}' if has_next else None,
+            'total': len(playlist['tracks']),
+        }, {}
+
+    def _playlist_summary(self, playlist):
+        return {
+            'id': playlist['id'], 'uri': playlist['uri'], 'name': playlist['name'],
+            'snapshot_id': playlist['snapshot_id'], 'owner': {'id': USER_ID},
+            'tracks': {'total': len(playlist['tracks'])},
+            'images': [{'url': f"{self.prefix}images/{playlist['id']}", 'width': 640, 'height': 640}],
+        }
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _serve(self):
+                url = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'null') if length else None
+                status, payload, headers = api.handle(self.command, url.path, query, body)
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if data:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
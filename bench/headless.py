@@ -0,0 +1,81 @@
+"""Stand-ins for the audio and keyboard, so the radio runs without a sound card or a display."""
+import sys
+import types
+
+# Length of every jingle the fake mixer "decodes" (seconds)
+JINGLE_SECONDS = 4.0
+
+
+class FakeSound:
+    def __init__(self, path):
+        self.path = path
+
+    def get_length(self):
+        return JINGLE_SECONDS
+
+    def play(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FakeListener:
+    """`pynput.keyboard.Listener` that never listens; the bench presses keys through `press()`."""
+
+    instances = []
+
+    def __init__(self, on_press=None, on_release=None):
+        self.on_press = on_press
+        FakeListener.instances.append(self)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FakeKey:
+    def __init__(self, char):
+        self.char = char
+
+
+def press(char):
+    """Press a key on every (fake) keyboard listener, as pynput would from its thread."""
+    for listener in FakeListener.instances:
+        listener.on_press(FakeKey(char))
+
+
+def install():
+    """Register fake `pygame` and `pynput` modules; call before importing radio_control."""
+    pygame = types.ModuleType('pygame')
+    pygame.error = type('error', (RuntimeError,), {})
+    mixer = types.ModuleType('pygame.mixer')
+    mixer.init = lambda *args, **kwargs: None
+    mixer.get_init = lambda: (44100, -16, 2)
+    mixer.Sound = FakeSound
+    pygame.mixer = mixer
+    sys.modules['pygame'] = pygame
+    sys.modules['pygame.mixer'] = mixer
+
+    pynput = types.ModuleType('pynput')
+    keyboard = types.ModuleType('pynput.keyboard')
+    keyboard.Listener = FakeListener
+    pynput.keyboard = keyboard
+    sys.modules['pynput'] = pynput
+    sys.modules['pynput.keyboard'] = keyboard
+
+
+def point_spotipy_at(prefix):
+    """Send every client made by `spotify_client.make_client` to the fake API at `prefix`."""
+    import spotify_client
+
+    make_client = spotify_client.make_client
+
+    def make_fake_client(*args, **kwargs):
+        client = make_client(*args, **kwargs)
+        client.prefix = prefix
+        return client
+
+    spotify_client.make_client = make_fake_client
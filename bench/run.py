@@ -0,0 +1,270 @@
+"""Offline benchmark: the radio and the web panel against a local fake Spotify API on a simulated clock.
+
+    python -m bench.run --hours 2 --latency-ms 120 --error-429 0.01 --tracks 500
+
+Needs the radio's own dependencies (spotipy, flask, ...) but no Spotify account, sound
+card or keyboard. Hours of playback run in seconds; only injected latency takes real time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bench import headless
+from bench.fake_spotify import FakeLibrary, FakeSpotify, Faults
+from bench.sim_clock import VirtualClock, VirtualTimeLoop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RADIO_SCOPE = "user-library-read user-read-playback-state user-modify-playback-state playlist-read-private"
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q / 100 * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(values):
+    if not values:
+        return {'n': 0}
+    return {'n': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p99': percentile(values, 99), 'max': max(values), 'mean': sum(values) / len(values)}
+
+
+def record(histogram, transform=None):
+    """Keep the raw values observed by a metrics histogram (optionally transformed), for percentiles."""
+    values = []
+    observe = histogram.observe
+
+    def observe_and_record(value, **labels):
+        observe(value, **labels)
+        values.append(transform(value) if transform else value)
+
+    histogram.observe = observe_and_record
+    return values
+
+
+def prepare_workdir(library, channels):
+    """A scratch directory with the radio's files: channels, command templates, jingles and a cached OAuth token."""
+    workdir = tempfile.mkdtemp(prefix='radio-bench-')
+    os.chdir(workdir)
+    with open('playlists.json', 'w') as f:
+        json.dump([playlist['uri'] for playlist in library.playlists[:channels]], f)
+    with open('commands.json', 'w') as f:
+        json.dump({'true': {'argv': ['true']}}, f)
+    os.mkdir('songs')
+    for name in ('jingle-a.mp3', 'jingle-b.mp3'):
+        open(os.path.join('songs', name), 'wb').close()
+    with open('.cache', 'w') as f:
+        json.dump({'access_token': 'bench-token', 'token_type': 'Bearer', 'refresh_token': 'bench-refresh',
+                   'scope': RADIO_SCOPE, 'expires_in': 3600, 'expires_at': int(time.time()) + 10 * 24 * 3600}, f)
+    os.environ.setdefault('SPOTIPY_CLIENT_ID', 'bench')
+    os.environ.setdefault('SPOTIPY_CLIENT_SECRET', 'bench')
+    os.environ.setdefault('SPOTIPY_REDIRECT_URI', 'http://127.0.0.1:5001/callback')
+    return workdir
+
+
+def track_busy(clock):
+    """Count Spotify calls and commands as real work, so simulated time doesn't skip over them."""
+    import command_executor
+    import spotify_scheduler
+
+    run = spotify_scheduler.SpotifyScheduler.run
+
+    async def tracked_run(self, *args, **kwargs):
+        clock.enter()
+        try:
+            return await run(self, *args, **kwargs)
+        finally:
+            clock.leave()
+
+    spotify_scheduler.SpotifyScheduler.run = tracked_run
+
+    run_command = command_executor.CommandExecutor.run
+
+    async def tracked_run_command(self, *args, **kwargs):
+        clock.enter()
+        try:
+            return await run_command(self, *args, **kwargs)
+        finally:
+            clock.leave()
+
+    command_executor.CommandExecutor.run = tracked_run_command
+
+
+async def listen(args, rng, command_queue):
+    """What the listeners do: zap in short bursts now and then, and queue commands from the panel."""
+    next_zap = rng.expovariate(1 / (args.zap_minutes * 60))
+    next_command = rng.expovariate(1 / (args.command_minutes * 60))
+    await asyncio.sleep(1)  # Let the radio start its keyboard listener
+    headless.press('-')  # Tune in
+    while True:
+        wait = min(next_zap, next_command)
+        await asyncio.sleep(wait)
+        next_zap -= wait
+        next_command -= wait
+        if next_zap <= 0:
+            for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                headless.press('-')
+                await asyncio.sleep(rng.uniform(0.05, 0.2))
+            next_zap = rng.expovariate(1 / (args.zap_minutes * 60))
+        if next_command <= 0:
+            command_queue.enqueue('true')
+            next_command = rng.expovariate(1 / (args.command_minutes * 60))
+
+
+async def run_radio(args, fake):
+    import radio_control
+    import radio_core
+    import station_break
+
+    station = radio_control.create_station()
+    zap_ms = record(radio_core.ZAP_LATENCY_SECONDS, lambda seconds: seconds * 1000)
+    gap_ms = record(station_break.JINGLE_GAP_SECONDS, lambda seconds: seconds * 1000)
+    # Against the fake player's actual track end, not the radio's own prediction
+    trigger_ms = record(radio_core.TRIGGER_ERROR_SECONDS, lambda seconds: seconds * 1000
+                        + station.tracker.remaining_ms() - (fake.player.remaining_ms() or 0))
+
+    radio = asyncio.ensure_future(radio_control.run(station))
+    listener = asyncio.ensure_future(listen(args, random.Random(args.seed), station.command_queue))
+    await asyncio.sleep(args.hours * 3600)
+    listener.cancel()
+    radio.cancel()
+    await asyncio.gather(radio, listener, return_exceptions=True)
+    station.store.stop()
+    return {
+        'zap_latency_ms': summarize(zap_ms),
+        'pre_end_trigger_error_ms': summarize(trigger_ms),
+        'station_break_gap_ms': summarize(gap_ms),
+        'shuffle': station.shuffle.stats(),
+        'boundary_hooks': station.tracker.stats()['jitter_ms'],
+    }
+
+
+def run_panel(requests_count):
+    """Time /playlists renders through Flask's test client: cold (catalogue sync), warm and conditional."""
+    import playlist_control
+
+    client = playlist_control.app.test_client()
+    with client.session_transaction() as session:
+        session['token_info'] = {'access_token': 'bench-token', 'refresh_token': 'bench-refresh',
+                                 'expires_at': int(time.time()) + 3600, 'scope': playlist_control.sp_oauth.scope}
+
+    def timed(**kwargs):
+        started = time.perf_counter()
+        response = client.get('/playlists', **kwargs)
+        return (time.perf_counter() - started) * 1000, response
+
+    cold_ms, response = timed()
+    etag = response.headers.get('ETag')
+    warm_ms = [timed()[0] for _ in range(requests_count)]
+    conditional_ms = [timed(headers={'If-None-Match': etag})[0] for _ in range(requests_count)] if etag else []
+    return {
+        'status': response.status_code,
+        'cold_ms': cold_ms,
+        'warm_ms': summarize(warm_ms),
+        'not_modified_ms': summarize(conditional_ms),
+    }
+
+
+def print_report(report):
+    print(f"Simulated playback: {report['hours']:.1f} h in {report['wall_seconds']:.1f} s")
+    print(f"API calls per hour of playback: {report['api_calls_per_hour']:.1f}")
+    for endpoint, count in sorted(report['api_calls'].items(), key=lambda item: -item[1]):
+        print(f"  {endpoint:<24} {count / report['hours']:8.1f} /h")
+    if report['api_errors']:
+        print(f"Injected errors: {report['api_errors']}")
+    for name, label in (('zap_latency_ms', 'Zap latency'),
+                        ('pre_end_trigger_error_ms', 'Pre-end trigger error (late > 0)'),
+                        ('station_break_gap_ms', 'Station-break gap')):
+        stats = report['radio'][name]
+        if not stats['n']:
+            print(f"{label}: no samples")
+            continue
+        print(f"{label} (ms, n={stats['n']}): p50 {stats['p50']:.0f}  p90 {stats['p90']:.0f}  "
+              f"p99 {stats['p99']:.0f}  max {stats['max']:.0f}")
+    for hook, stats in report['radio']['boundary_hooks'].items():
+        print(f"Boundary hook {hook} jitter (ms, n={stats['n']}): p50 {stats['p50']:.1f}  max {stats['max']:.1f}")
+    shuffle = report['radio']['shuffle']
+    print(f"Plays: {shuffle['plays']}, repeats: {shuffle['repeats']} ({shuffle['repeat_rate']:.1%})")
+    panel = report['panel']
+    if panel:
+        print(f"/playlists render (ms): cold {panel['cold_ms']:.1f}  warm p50 {panel['warm_ms']['p50']:.1f}  "
+              f"p90 {panel['warm_ms']['p90']:.1f}", end='')
+        if panel['not_modified_ms']['n']:
+            print(f"  304 p50 {panel['not_modified_ms']['p50']:.1f}", end='')
+        print(f"  (status {panel['status']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hours', type=float, default=1.0, help='simulated hours of playback')
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--playlists', type=int, default=40, help='playlists in the fake library')
+    parser.add_argument('--tracks', type=int, default=200, help='tracks per playlist')
+    parser.add_argument('--latency-ms', type=float, default=80)
+    parser.add_argument('--jitter-ms', type=float, default=40)
+    parser.add_argument('--error-403', type=float, default=0.0, help='share of player commands failing with 403')
+    parser.add_argument('--error-429', type=float, default=0.0, help='share of requests failing with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--zap-minutes', type=float, default=10, help='mean simulated minutes between zaps')
+    parser.add_argument('--command-minutes', type=float, default=15, help='mean simulated minutes between commands')
+    parser.add_argument('--panel-requests', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    clock = VirtualClock()
+    clock.install()
+    headless.install()
+    sys.path.insert(0, ROOT)
+
+    library = FakeLibrary(args.playlists, args.tracks, seed=args.seed)
+    faults = Faults(args.latency_ms, args.jitter_ms, args.error_403, args.error_429, args.retry_after, seed=args.seed)
+    fake = FakeSpotify(library, faults, clock=clock.now).start()
+    prepare_workdir(library, args.channels)
+    headless.point_spotipy_at(fake.prefix)
+    track_busy(clock)
+
+    loop = VirtualTimeLoop(clock)
+    asyncio.set_event_loop(loop)
+    started = time.perf_counter()
+    try:
+        radio = loop.run_until_complete(run_radio(args, fake))
+    finally:
+        loop.close()
+    wall_seconds = time.perf_counter() - started
+    radio_calls = dict(fake.calls)
+
+    panel = run_panel(args.panel_requests) if args.panel_requests else None
+    fake.stop()
+    if fake.not_found:
+        # The radio fell back on some path the fake doesn't serve; the figures wouldn't mean much
+        missing = ', '.join(f'{method} {path} ({count}x)' for (method, path), count in fake.not_found.most_common(5))
+        sys.exit(f"The fake Spotify API answered 404 to: {missing}")
+
+    report = {
+        'hours': args.hours,
+        'wall_seconds': wall_seconds,
+        'api_calls': radio_calls,
+        'api_calls_per_hour': sum(radio_calls.values()) / args.hours,
+        'api_errors': {f'{endpoint} {status}': count for (endpoint, status), count in fake.errors.items()},
+        'radio': radio,
+        'panel': panel,
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
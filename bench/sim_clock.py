@@ -0,0 +1,86 @@
+import asyncio
+import selectors
+import threading
+import time
+
+# Longest real wait while Spotify calls or executor jobs are in flight (seconds)
+BUSY_POLL = 0.005
+
+_real_monotonic = time.monotonic
+
+
+class VirtualClock:
+    """Simulated monotonic clock for running hours of radio in seconds.
+
+    While nothing is in flight, the event loop jumps straight to its next timer; while
+    Spotify calls, executor jobs or commands are running (`busy`), simulated time
+    follows real time, so injected latency counts in full.
+    """
+
+    def __init__(self, start=1000.0):
+        self._now = start
+        self._lock = threading.Lock()
+        self._busy = 0
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += max(seconds, 0.0)
+
+    @property
+    def busy(self):
+        return self._busy > 0
+
+    def enter(self):
+        with self._lock:
+            self._busy += 1
+
+    def leave(self, *_):
+        with self._lock:
+            self._busy -= 1
+
+    def track(self, future):
+        """Count `future` (concurrent or asyncio) as in flight until it is done."""
+        self.enter()
+        future.add_done_callback(self.leave)
+        return future
+
+    def install(self):
+        """Make `time.monotonic()` simulated; call before importing the radio's modules."""
+        time.monotonic = self.now
+
+
+def _virtual_selector(clock):
+    base = selectors.DefaultSelector
+
+    class VirtualTimeSelector(base):
+        def select(self, timeout=None):
+            if clock.busy or timeout is None:
+                # Something real is happening: wait for it in real time
+                wait = BUSY_POLL if timeout is None else min(timeout, BUSY_POLL)
+                started = _real_monotonic()
+                events = super().select(wait)
+                clock.advance(_real_monotonic() - started)
+                return events
+            events = super().select(0)
+            if not events:
+                clock.advance(timeout)
+            return events
+
+    return VirtualTimeSelector()
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop running on a `VirtualClock`."""
+
+    def __init__(self, clock):
+        super().__init__(_virtual_selector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.now()
+
+    def run_in_executor(self, executor, func, *args):
+        return self.clock.track(super().run_in_executor(executor, func, *args))
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import random
+
+from ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+# Playlist metadata is kept this long before it is fetched again (seconds)
+PREFETCH_TTL = 600
+PREFETCH_CACHE_SIZE = 32
+
+PLAYLIST_FIELDS = 'name,snapshot_id,tracks.total,images'
+
+
+class ChannelPrefetcher:
+    """Warms playlist metadata for the channels next to the current one in the background.
+
+    Each cached entry carries a pre-picked shuffled start offset, so a zap can start
+    playback at a random track and update the display without any lookups of its own.
+    `fetch_playlist(uri, fields)` is a coroutine function returning the playlist object.
+    With a `shuffle` engine, the channel's track URIs are loaded into it as well, via the
+    `fetch_tracks(uri)` coroutine function, whenever the playlist's snapshot has changed.
+    """
+
+    def __init__(self, fetch_playlist, ttl=PREFETCH_TTL, maxsize=PREFETCH_CACHE_SIZE,
+                 fetch_tracks=None, shuffle=None):
+        self.fetch_playlist = fetch_playlist
+        self.fetch_tracks = fetch_tracks
+        self.shuffle = shuffle
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._pending = {}  # playlist_uri -> task
+
+    def warm(self, channels, channel_index):
+        """Prefetch the next and previous channels of `channel_index`; must be called on the event loop."""
+        if not channels:
+            return
+        for neighbour in (channel_index + 1, channel_index - 1):
+            self.prefetch(channels[neighbour % len(channels)])
+
+    def prefetch(self, playlist_uri):
+        if self.cache.get(playlist_uri) is not None or playlist_uri in self._pending:
+            return
+        self._pending[playlist_uri] = asyncio.ensure_future(self._prefetch(playlist_uri))
+
+    def get(self, playlist_uri):
+        """Cached channel info, or None if it hasn't been prefetched (or has expired)."""
+        return self.cache.get(playlist_uri)
+
+    def take(self, playlist_uri):
+        """Cached channel info for playing now; a fresh start offset is picked for the next visit."""
+        info = self.cache.get(playlist_uri)
+        if info is None:
+            return None
+        next_info = dict(info, start_offset=self._pick_offset(info['track_count']))
+        self.cache.set(playlist_uri, next_info)
+        return info
+
+    @staticmethod
+    def _pick_offset(track_count):
+        return random.randrange(track_count) if track_count else 0
+
+    async def _prefetch(self, playlist_uri):
+        try:
+            playlist = await self.fetch_playlist(playlist_uri, fields=PLAYLIST_FIELDS)
+            track_count = playlist['tracks']['total']
+            images = playlist.get('images') or []
+            self.cache.set(playlist_uri, {
+                'uri': playlist_uri,
+                'name': playlist['name'],
+                'snapshot_id': playlist.get('snapshot_id'),
+                'track_count': track_count,
+                'start_offset': self._pick_offset(track_count),
+                'image_url': images[0]['url'] if images else None,
+            })
+            snapshot_id = playlist.get('snapshot_id')
+            if self.shuffle is not None and not self.shuffle.has_tracks(playlist_uri, snapshot_id):
+                self.shuffle.load(playlist_uri, snapshot_id, await self.fetch_tracks(playlist_uri))
+        except Exception as e:
+            log.warning("Error prefetching %s: %s", playlist_uri, e)
+        finally:
+            self._pending.pop(playlist_uri, None)
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# How often the watcher thread checks the playlist file for changes (seconds)
+WATCH_INTERVAL = 1.0
+
+
+def atomic_write_json(path, data):
+    """Write JSON to a temp file next to `path` and rename it into place.
+
+    Readers either see the old file or the new one, never a half-written one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class ChannelRegistry:
+    """In-memory list of radio channels (playlist URIs) backed by the playlists file.
+
+    The file is only re-read when its mtime or size changes. With `start_watching()` the
+    check happens on a background thread, so `channels()` does no disk I/O at all.
+    """
+
+    def __init__(self, path, watch_interval=WATCH_INTERVAL):
+        self.path = path
+        self.watch_interval = watch_interval
+        self._channels = []
+        self._signature = None
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop = threading.Event()
+        self.reloads = 0
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def refresh(self):
+        """Reload the channel list if the file changed. Returns True when it was reloaded."""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return False
+
+        if signature is None:
+            channels = []
+            log.warning("No playlists found. Please add playlists via the web interface.")
+        else:
+            try:
+                with open(self.path, 'r') as file:
+                    channels = json.load(file)
+            except (OSError, json.JSONDecodeError) as e:
+                # Keep broadcasting the last good list; the next change will be picked up
+                log.error("Error reading %s, keeping previous playlists: %s", self.path, e)
+                return False
+            log.info("Loaded playlists: %s", channels)
+
+        with self._lock:
+            self._channels = channels
+            self._signature = signature
+            self.reloads += 1
+        return True
+
+    def channels(self):
+        """The current channel list."""
+        if self._watcher is None:
+            self.refresh()
+        with self._lock:
+            return self._channels
+
+    def start_watching(self):
+        """Check the file for changes on a background thread instead of on every call."""
+        self.refresh()
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.watch_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error("Error watching %s: %s", self.path, e)
@@ -0,0 +1,153 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# SQLite database shared by the web panel and the radio
+DB_FILE = 'radio.db'
+
+# Unix datagram socket the radio listens on for "new command" notifications
+SOCKET_FILE = 'radio_commands.sock'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    created_at REAL NOT NULL,
+    claimed_at REAL,
+    acked_at REAL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS commands_status_id ON commands (status, id);
+"""
+
+
+def connect(db_path=DB_FILE):
+    """Open a connection to the shared database in WAL mode, so readers never block the writer."""
+    conn = sqlite3.connect(db_path, timeout=5, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class CommandQueue:
+    """Ordered, persistent command queue between the web panel and the radio.
+
+    The panel `enqueue`s and pokes the radio's socket; the radio `claim`s the oldest
+    queued command and `ack`s it once it has run. Each command is claimed by exactly
+    one transaction, so it is never lost between read and clear, nor run twice.
+    """
+
+    def __init__(self, db_path=DB_FILE, socket_path=SOCKET_FILE):
+        self.db_path = db_path
+        self.socket_path = socket_path
+        self._local = threading.local()
+        self._socket = None
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    # Panel side
+
+    def enqueue(self, command):
+        """Add a command to the end of the queue and notify the radio. Returns its id."""
+        cursor = self._conn().execute(
+            'INSERT INTO commands (command, created_at) VALUES (?, ?)', (command, time.time()))
+        self.notify()
+        return cursor.lastrowid
+
+    def notify(self):
+        """Wake the radio, if it is listening; the queue itself is the source of truth."""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.setblocking(False)
+                sock.sendto(b'\x01', self.socket_path)
+        except (OSError, AttributeError):
+            pass
+
+    def pending(self):
+        """Queued (not yet claimed) commands, oldest first, as (id, command) tuples."""
+        rows = self._conn().execute(
+            "SELECT id, command FROM commands WHERE status = 'queued' ORDER BY id").fetchall()
+        return [(row['id'], row['command']) for row in rows]
+
+    def peek(self):
+        """The next command to run, without claiming it."""
+        row = self._conn().execute(
+            "SELECT command FROM commands WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+        return row['command'] if row else None
+
+    def recent(self, limit=20):
+        rows = self._conn().execute(
+            'SELECT id, command, status, created_at, acked_at, result FROM commands ORDER BY id DESC LIMIT ?',
+            (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    # Radio side
+
+    def claim(self):
+        """Atomically take the oldest queued command. Returns (id, command) or None."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT id, command FROM commands WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE commands SET status = 'claimed', claimed_at = ? WHERE id = ?",
+                             (time.time(), row['id']))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return (row['id'], row['command']) if row else None
+
+    def ack(self, command_id, result=None, status='done'):
+        """Mark a claimed command as finished."""
+        self._conn().execute(
+            'UPDATE commands SET status = ?, acked_at = ?, result = ? WHERE id = ?',
+            (status, time.time(), result, command_id))
+
+    def requeue_unacked(self):
+        """Put commands claimed by a radio that died before acking them back in the queue."""
+        cursor = self._conn().execute("UPDATE commands SET status = 'queued' WHERE status = 'claimed'")
+        return cursor.rowcount
+
+    def listen(self):
+        """Bind the notification socket. Returns False if Unix sockets are unavailable."""
+        try:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(self.socket_path)
+        except (OSError, AttributeError) as e:
+            log.warning("Command notifications unavailable, falling back to polling: %s", e)
+            return False
+        self._socket = sock
+        return True
+
+    def fileno(self):
+        """File descriptor of the notification socket, for `loop.add_reader()` (None if not listening)."""
+        return self._socket.fileno() if self._socket is not None else None
+
+    def drain(self):
+        """Read every pending notification without blocking. Returns True if there were any."""
+        notified = False
+        try:
+            while True:
+                self._socket.recv(16, socket.MSG_DONTWAIT)
+                notified = True
+        except (BlockingIOError, OSError):
+            pass
+        return notified
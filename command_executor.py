@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+import shlex
+import signal
+import sys
+import time
+from collections import deque
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+# Named command templates the web panel may queue: {"name": {"argv": [...], "timeout": 60, ...}}
+COMMANDS_FILE = 'commands.json'
+
+# Commands running at the same time; more wait for a free slot
+MAX_WORKERS = 2
+
+# Defaults for templates that don't set their own limits
+COMMAND_TIMEOUT = 60  # Wall-clock seconds before the command (and everything it started) is killed
+CPU_SECONDS = 30  # RLIMIT_CPU
+MEMORY_MB = 256  # RLIMIT_AS
+
+# Commands run at this niceness, so they never compete with the radio for the CPU
+NICENESS = 10
+
+# Output lines kept per command (the last ones), and streamed to the web panel
+MAX_OUTPUT_LINES = 200
+MAX_LINE_LENGTH = 4096
+
+COMMAND_SECONDS = Histogram('command_seconds', 'Duration of custom commands',
+                            buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0))
+COMMANDS = Counter('commands', 'Custom commands run', ('result',))
+
+
+class CommandRejected(ValueError):
+    """The command doesn't name an allowed template, or doesn't fit it."""
+
+
+class CommandTemplate:
+    """An allowed command: a fixed argv with `{0}`, `{1}`, ... filled in from the queued command's arguments."""
+
+    def __init__(self, name, argv, timeout=COMMAND_TIMEOUT, cpu_seconds=CPU_SECONDS, memory_mb=MEMORY_MB):
+        self.name = name
+        self.argv = list(argv)
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+
+    def render(self, args):
+        """The argv for `args`; each argument becomes (part of) one argv item, never shell syntax."""
+        try:
+            return [item.format(*args) for item in self.argv]
+        except IndexError:
+            raise CommandRejected(f"Not enough arguments for {self.name}") from None
+
+
+class CommandAllowlist:
+    """The command templates in `commands.json`, re-read whenever the file changes.
+
+    A queued command is "<template name> [arguments...]", split like a shell would
+    but never run by one.
+    """
+
+    def __init__(self, path=COMMANDS_FILE):
+        self.path = path
+        self.templates = {}
+        self._signature = None
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._signature is not None or not self.templates:
+                log.warning("No command templates found in %s; every command will be rejected.", self.path)
+            self.templates, self._signature = {}, None
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+            templates = {name: CommandTemplate(name, **entry) for name, entry in entries.items()}
+        except (OSError, ValueError, TypeError) as e:
+            # Keep the last good templates; the next change will be picked up
+            log.error("Error reading %s, keeping previous command templates: %s", self.path, e)
+            return
+        self.templates, self._signature = templates, signature
+        log.info("Loaded command templates: %s", ', '.join(templates))
+
+    def resolve(self, command):
+        """(template, argv) for a queued command; raises CommandRejected."""
+        self.refresh()
+        try:
+            words = shlex.split(command)
+        except ValueError as e:
+            raise CommandRejected(f"Can't parse command: {e}") from None
+        if not words:
+            raise CommandRejected("Empty command")
+        template = self.templates.get(words[0])
+        if template is None:
+            raise CommandRejected(f"Unknown command: {words[0]}")
+        return template, template.render(words[1:])
+
+
+# Run in front of every command: lowers its priority, sets its rlimits and execs it, so nothing has to run
+# in the forked child before exec (the radio has threads, which makes preexec_fn unsafe).
+# Arguments: niceness, CPU seconds, address space bytes (0: no limit), then the command's argv.
+LIMITS_WRAPPER = """\
+import os, resource, sys
+niceness, cpu_seconds, memory = (int(value) for value in sys.argv[1:4])
+os.nice(niceness)
+if cpu_seconds:
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+if memory:
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+try:
+    os.execvp(sys.argv[4], sys.argv[4:])
+except OSError as e:
+    sys.exit(f"Can't start {sys.argv[4]}: {e}")
+"""
+
+
+def limited_argv(template, argv):
+    """`argv` behind the limits wrapper, with the template's niceness and rlimits."""
+    memory = template.memory_mb * 1024 * 1024 if template.memory_mb else 0
+    return [sys.executable, '-I', '-S', '-c', LIMITS_WRAPPER,
+            str(NICENESS), str(template.cpu_seconds or 0), str(memory), *argv]
+
+
+def _kill(process):
+    """Kill the command and everything it started (it runs in a session of its own)."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class CommandExecutor:
+    """Runs allowed commands in a bounded pool of child processes, on the radio's event loop.
+
+    Commands are exec'd from their template (no shell) in a new session, at low
+    priority and with CPU time and memory rlimits set by `LIMITS_WRAPPER`; one that
+    runs past its timeout is killed with everything it started. Output is read line by
+    line as it comes and handed to `on_output(stream, line)`. The radio only ever waits
+    on pipes, so nothing a command does can hold up playback.
+    """
+
+    def __init__(self, allowlist=None, max_workers=MAX_WORKERS):
+        self.allowlist = allowlist or CommandAllowlist()
+        self.max_workers = max_workers
+        self._slots = None  # asyncio.Semaphore, created on the loop at first use
+        self.running = 0
+
+    async def run(self, command, on_output=None):
+        """Run a queued command. Returns (returncode, output); returncode is None if it didn't run to the end."""
+        try:
+            template, argv = self.allowlist.resolve(command)
+        except CommandRejected as e:
+            log.warning("Rejected command %r: %s", command, e)
+            COMMANDS.inc(result='rejected')
+            return None, str(e)
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        async with self._slots:
+            self.running += 1
+            try:
+                return await self._run(template, argv, on_output)
+            finally:
+                self.running -= 1
+
+    async def _run(self, template, argv, on_output):
+        started = time.monotonic()
+        lines = deque(maxlen=MAX_OUTPUT_LINES)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *limited_argv(template, argv), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, start_new_session=True, limit=MAX_LINE_LENGTH)
+        except OSError as e:
+            log.error("Can't start command %s: %s", template.name, e)
+            COMMANDS.inc(result='error')
+            return None, str(e)
+
+        result = 'ok'
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                self._pump(process.stdout, 'stdout', lines, on_output),
+                self._pump(process.stderr, 'stderr', lines, on_output),
+                process.wait()), template.timeout)
+        except asyncio.TimeoutError:
+            log.warning("Command %s timed out after %s seconds, killed.", template.name, template.timeout)
+            _kill(process)
+            await process.wait()
+            result = 'timeout'
+        except asyncio.CancelledError:
+            _kill(process)
+            raise
+
+        duration = time.monotonic() - started
+        COMMAND_SECONDS.observe(duration)
+        if result == 'ok' and process.returncode != 0:
+            result = 'failed'
+        COMMANDS.inc(result=result)
+        log.info("Command %s exited with %s after %.2f s", template.name, process.returncode, duration)
+        return (process.returncode if result != 'timeout' else None), '\n'.join(lines)
+
+    @staticmethod
+    async def _pump(stream, name, lines, on_output):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # A line longer than the limit: take it in pieces
+                line = await stream.read(MAX_LINE_LENGTH)
+            if not line:
+                return
+            text = line.decode(errors='replace').rstrip('\n')
+            lines.append(text)
+            if on_output is not None:
+                try:
+                    on_output(name, text)
+                except Exception as e:
+                    log.error("Error streaming command output: %s", e)
+
+    def stats(self):
+        return {'running': self.running, 'max_workers': self.max_workers}
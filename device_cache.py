@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+import spotipy
+
+log = logging.getLogger(__name__)
+
+# Bounded backoff for retrying transient playback errors
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.25  # seconds
+RETRY_MAX_DELAY = 2.0  # seconds
+
+
+async def call_with_backoff(call, retry_statuses=(403,), attempts=RETRY_ATTEMPTS,
+                            base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """Await `call()`, retrying Spotify errors in `retry_statuses` with exponential backoff."""
+    delay = base_delay
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call()
+        except spotipy.SpotifyException as e:
+            if e.http_status not in retry_statuses or attempt == attempts:
+                raise
+            log.warning("Received %s error, retrying in %.2f seconds...", e.http_status, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+class DeviceCache:
+    """Remembers the playback device and its shuffle state so a zap doesn't have to ask Spotify first."""
+
+    def __init__(self, device_name=None):
+        self.device_name = device_name  # Preferred device, by name
+        self._device_id = None
+        self._shuffle = {}  # device_id -> last known shuffle state
+        self.lookups = 0
+
+    async def device_id(self, fetch_devices):
+        """The cached device ID, looked up on a cache miss: the preferred device, else the active one, else the first.
+
+        `fetch_devices` is a coroutine function returning the `devices()` response.
+        """
+        if self._device_id is not None:
+            return self._device_id
+
+        devices = (await fetch_devices())['devices']
+        self.lookups += 1
+        if not devices:
+            return None
+        named = [device for device in devices if self.device_name and device.get('name') == self.device_name]
+        active = [device for device in devices if device.get('is_active')]
+        self._device_id = (named or active or devices)[0]['id']
+        return self._device_id
+
+    def invalidate(self):
+        """Forget the device, e.g. after a playback error."""
+        if self._device_id is not None:
+            self._shuffle.pop(self._device_id, None)
+        self._device_id = None
+
+    async def ensure_shuffle(self, set_shuffle, device_id, state):
+        """Set shuffle on `device_id` only when it isn't known to be in `state` already.
+
+        `set_shuffle(state, device_id=...)` is a coroutine function.
+        """
+        if self._shuffle.get(device_id) == state:
+            return False
+        await set_shuffle(state, device_id=device_id)
+        self._shuffle[device_id] = state
+        return True
+
+    def observe(self, playback):
+        """Update the cache from a `current_playback()` snapshot we fetched anyway."""
+        if not playback or not playback.get('device'):
+            return
+        device_id = playback['device'].get('id')
+        if not device_id:
+            return
+        self._device_id = device_id
+        if 'shuffle_state' in playback:
+            self._shuffle[device_id] = playback['shuffle_state']
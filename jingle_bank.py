@@ -0,0 +1,140 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+JINGLE_EXTENSIONS = ('.mp3', '.wav', '.ogg')
+
+# Upper bound for decoded jingle buffers kept in memory (bytes)
+MEMORY_CAP = 64 * 1024 * 1024
+
+
+def open_mixer():
+    """Import pygame and open the audio device, unless it is open already. Returns the pygame module."""
+    import pygame
+
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    return pygame
+
+
+class JingleBank:
+    """Decodes every clip in a folder once into `pygame.mixer.Sound` buffers and rotates between them.
+
+    Decoded buffers are kept in LRU order under `memory_cap`; a clip evicted to make
+    room is decoded again the next time it is picked. `weights` maps file names to
+    relative weights (default 1); the same clip is never picked twice in a row when
+    there is another one to choose from.
+
+    Opening the audio device is slow on small boards, so nothing happens until the
+    first jingle is needed: `next()` then opens the mixer, decodes the clip it picked
+    and decodes the rest on a background thread. `load()` does it all up front.
+    """
+
+    def __init__(self, directory, memory_cap=MEMORY_CAP, weights=None):
+        self.directory = directory
+        self.memory_cap = memory_cap
+        self.weights = weights or {}
+        self.paths = []
+        self._sounds = OrderedDict()  # name -> (Sound, size in bytes)
+        self._memory_used = 0
+        self._last_played = None
+        self._lock = threading.Lock()
+        self._pygame = None  # Imported, with the mixer open, on first use
+        self._scanned = False
+        self._warmer = None
+        self.decodes = 0
+
+    def audio(self):
+        """The pygame module, opening the audio device the first time."""
+        with self._lock:
+            if self._pygame is None:
+                started = time.perf_counter()
+                self._pygame = open_mixer()
+                log.info("Audio opened in %.0f ms", (time.perf_counter() - started) * 1000)
+            return self._pygame
+
+    def scan(self):
+        """Find the jingle files in the folder."""
+        self._scanned = True
+        if not os.path.isdir(self.directory):
+            log.warning("Jingle folder not found: %s", self.directory)
+            self.paths = []
+            return self.paths
+        self.paths = sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.lower().endswith(JINGLE_EXTENSIONS)
+        )
+        return self.paths
+
+    def load(self):
+        """Scan the folder and decode every clip up front, so station breaks never decode."""
+        pygame = self.audio()
+        for path in self.scan():
+            try:
+                self.sound(path)
+            except pygame.error as e:
+                log.error("Error decoding jingle %s: %s", path, e)
+        log.info("Loaded %d jingles (%.1f MB)", len(self._sounds), self._memory_used / 1024 / 1024)
+
+    def warm(self):
+        """Decode every clip on a background thread, once."""
+        with self._lock:
+            if self._warmer is not None:
+                return
+            self._warmer = threading.Thread(target=self.load, daemon=True)
+        self._warmer.start()
+
+    def _sound_size(self, sound):
+        frequency, sample_format, channels = self._pygame.mixer.get_init()
+        return int(sound.get_length() * frequency) * channels * (abs(sample_format) // 8)
+
+    def sound(self, path):
+        """The decoded Sound for `path`, decoding it (and evicting old clips) if needed."""
+        name = os.path.basename(path)
+        with self._lock:
+            if name in self._sounds:
+                self._sounds.move_to_end(name)
+                return self._sounds[name][0]
+
+        sound = self.audio().mixer.Sound(path)
+        size = self._sound_size(sound)
+        with self._lock:
+            self.decodes += 1
+            if name in self._sounds:
+                # Decoded by another thread meanwhile; keep that buffer so the count stays right
+                self._sounds.move_to_end(name)
+                return self._sounds[name][0]
+            self._sounds[name] = (sound, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_cap and len(self._sounds) > 1:
+                _, (_, evicted_size) = self._sounds.popitem(last=False)
+                self._memory_used -= evicted_size
+        return sound
+
+    def pick(self):
+        """Choose the next jingle path by weight, avoiding an immediate repeat."""
+        candidates = [path for path in self.paths if self.weights.get(os.path.basename(path), 1) > 0]
+        if len(candidates) > 1 and self._last_played in candidates:
+            candidates.remove(self._last_played)
+        if not candidates:
+            return None
+        weights = [self.weights.get(os.path.basename(path), 1) for path in candidates]
+        path = random.choices(candidates, weights=weights)[0]
+        self._last_played = path
+        return path
+
+    def next(self):
+        """Return (path, Sound) for the next jingle, or (None, None) if there are none."""
+        if not self._scanned:
+            self.scan()
+        path = self.pick()
+        if path is None:
+            return None, None
+        sound = self.sound(path)
+        self.warm()
+        return path, sound
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from metrics import Counter
+
+# Presses closer together than this are merged into one action (milliseconds)
+COALESCE_WINDOW_MS = 250
+
+# Key -> action
+DEFAULT_BINDINGS = {
+    '-': 'zap',
+    '=': 'play_pause',
+}
+
+# Spotify calls one action costs: a zap is a start_playback, a toggle a snapshot plus pause/start
+API_CALLS_PER_ACTION = {
+    'zap': 1,
+    'play_pause': 2,
+}
+
+KEY_API_CALLS_COALESCED = Counter('key_api_calls_coalesced', 'Spotify calls saved by merging bursts of key presses')
+
+
+class KeyCoalescer:
+    """Merges bursts of key presses into a single playback change.
+
+    Every press updates the display right away; the station only acts once no key has
+    been pressed for `window_ms`. Five presses of `-` become one zap to the channel five
+    steps ahead, and an even number of `=` presses cancels out. Must be used on the
+    station's event loop.
+    """
+
+    def __init__(self, station, window_ms=COALESCE_WINDOW_MS, bindings=None):
+        self.station = station
+        self.window_ms = window_ms
+        self.bindings = bindings or DEFAULT_BINDINGS
+        self._pending = {'zap': 0, 'play_pause': 0}
+        self._burst_started_at = None
+        self._flush_handle = None
+
+        self.presses = 0
+        self.actions = 0
+        self.api_calls_coalesced = 0
+
+    def on_key(self, char):
+        action = self.bindings.get(char)
+        if action is None:
+            return
+        self.presses += 1
+        if self._burst_started_at is None:
+            self._burst_started_at = time.monotonic()
+        self._pending[action] += 1
+
+        if action == 'zap':
+            self.station.preview_channel(self.station.current_channel + self._pending['zap'])
+        else:
+            self.station.display("Play/Pause" if self._pending['play_pause'] % 2 else "Play/Pause cancelled")
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(self.window_ms / 1000, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        zaps, toggles = self._pending['zap'], self._pending['play_pause']
+        self._pending = {'zap': 0, 'play_pause': 0}
+        burst_started_at, self._burst_started_at = self._burst_started_at, None
+
+        issued_zaps = 1 if zaps else 0
+        issued_toggles = toggles % 2
+        self.actions += issued_zaps + issued_toggles
+        coalesced = (zaps - issued_zaps) * API_CALLS_PER_ACTION['zap'] \
+            + (toggles - issued_toggles) * API_CALLS_PER_ACTION['play_pause']
+        self.api_calls_coalesced += coalesced
+        if coalesced:
+            KEY_API_CALLS_COALESCED.inc(coalesced)
+
+        if zaps:
+            self.station.zap_by(zaps, burst_started_at)
+        if issued_toggles:
+            self.station.toggle_play_pause()
+
+    def stats(self):
+        return {
+            'presses': self.presses,
+            'actions': self.actions,
+            'api_calls_coalesced': self.api_calls_coalesced,
+        }
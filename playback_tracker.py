@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+# Lead time before the end of a track at which boundary hooks fire
+DEFAULT_LEAD_MS = 1000
+
+# A snapshot of the same track this far behind its predicted progress is a new play of it (repeat, seek back)
+RESTART_TOLERANCE_MS = 3000
+
+# Hooks fire this much earlier than their lead time to make up for the one-way trip of the call they make,
+# estimated as half the smoothed snapshot round-trip, and never more than MAX_LATENCY_COMPENSATION_MS
+LATENCY_SMOOTHING = 0.2  # Weight of each new round-trip
+MAX_LATENCY_COMPENSATION_MS = 500
+
+# Jitter samples kept per hook for stats()
+JITTER_SAMPLES = 200
+
+BOUNDARY_JITTER_SECONDS = Histogram('boundary_hook_jitter_seconds',
+                                    'How late (positive) or early boundary hooks ran against their target', ('hook',),
+                                    buckets=(-0.1, -0.05, -0.01, -0.005, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5))
+PLAYBACK_SNAPSHOTS = Counter('playback_snapshots', 'Playback snapshots taken by the tracker')
+PLAYBACK_CALLS_SAVED = Counter('playback_calls_saved',
+                               'Snapshots saved compared to polling current_playback() once per second')
+
+# Re-sync cadence (seconds)
+MAX_SYNC_INTERVAL = 30.0  # Longest gap between snapshots mid-track
+NEAR_END_WINDOW = 6.0  # Start dense re-syncs this long before the trigger
+NEAR_END_INTERVAL = 2.5  # Gap between snapshots inside the near-end window
+POST_END_DELAY = 1.0  # Re-sync this long after the predicted track end
+IDLE_INTERVAL = 5.0  # Gap between snapshots while nothing is playing
+MIN_SYNC_INTERVAL = 0.2
+
+
+class BoundaryHook:
+    """A callback run `lead_ms` before each track boundary, as `callback(playback, boundary)`."""
+
+    def __init__(self, name, callback, lead_ms):
+        self.name = name
+        self.callback = callback
+        self.lead_ms = lead_ms
+        self.jitter_ms = deque(maxlen=JITTER_SAMPLES)
+
+
+class PlaybackTracker:
+    """Follows Spotify playback from sparse snapshots and runs track-boundary hooks on a local timer.
+
+    Each snapshot anchors the track position to the monotonic clock, so the end of the
+    track can be predicted without asking Spotify again. `fetch_playback` is a coroutine
+    function returning the `current_playback()` dict (or None).
+
+    Every play of a track gets a new instance number, also when the same track plays
+    again or is sought back, and each hook runs exactly once per (track URI, instance).
+    The boundary is where the next track starts: `crossfade_ms` (Spotify's crossfade
+    setting, which the Web API doesn't report) before the end of the track. Hooks run
+    their `lead_ms` before it, plus half the measured API round-trip, so the call a hook
+    makes reaches Spotify on time. `on_about_to_end`, if given, is registered as the
+    hook named 'about_to_end'.
+    """
+
+    def __init__(self, fetch_playback, on_about_to_end=None, lead_ms=DEFAULT_LEAD_MS, crossfade_ms=0,
+                 compensate_latency=True, clock=time.monotonic):
+        self.fetch_playback = fetch_playback
+        self.lead_ms = lead_ms
+        self.crossfade_ms = crossfade_ms
+        self.compensate_latency = compensate_latency
+        self.clock = clock
+        self.hooks = {}  # name -> BoundaryHook, in registration order
+        if on_about_to_end is not None:
+            self.add_hook('about_to_end', on_about_to_end)
+
+        self.playback = None  # Last snapshot returned by Spotify
+        self.instance = 0  # Play instance of the current track
+        self.latency_ms = None  # Smoothed snapshot round-trip
+        self._anchor_time = None  # Monotonic time the snapshot's progress_ms refers to
+        self._fired = set()  # Hooks already run for the current track instance
+        self._timer = None
+        self._timer_at = None
+        self._wake = None  # asyncio.Event, created on the loop in run()
+        self._stopped = False
+        self._next_sync_at = None
+
+        self.started_at = None
+        self.api_calls = 0
+        self.triggers = 0
+        self._calls_saved_counted = 0  # Part of calls_saved() already added to PLAYBACK_CALLS_SAVED
+
+    # Hooks
+
+    def add_hook(self, name, callback, lead_ms=None):
+        """Run `callback(playback, boundary)` `lead_ms` (default: the tracker's) before every track boundary.
+
+        `boundary` is a dict with the track `uri`, its play `instance`, the `target_ms`
+        before the boundary the hook aimed for and how late it ran (`jitter_ms`).
+        """
+        self.hooks[name] = BoundaryHook(name, callback, self.lead_ms if lead_ms is None else lead_ms)
+        if self._anchor_time is not None:
+            self._schedule_trigger()
+
+    def remove_hook(self, name):
+        self.hooks.pop(name, None)
+
+    def latency_compensation_ms(self):
+        if not self.compensate_latency or self.latency_ms is None:
+            return 0
+        return min(self.latency_ms / 2, MAX_LATENCY_COMPENSATION_MS)
+
+    def target_ms(self, hook):
+        """How long before the boundary `hook` should run."""
+        return hook.lead_ms + self.latency_compensation_ms()
+
+    def boundary(self):
+        """Key of the current track instance: (track URI, instance)."""
+        if not self.playback or not self.playback.get('item'):
+            return None
+        return self.playback['item']['uri'], self.instance
+
+    # Snapshot handling
+
+    async def sync(self):
+        """Take one playback snapshot from Spotify and re-plan the trigger timer."""
+        before = self.clock()
+        playback = await self.fetch_playback()
+        after = self.clock()
+        self.api_calls += 1
+        PLAYBACK_SNAPSHOTS.inc()
+        saved = self.calls_saved()
+        if saved > self._calls_saved_counted:
+            PLAYBACK_CALLS_SAVED.inc(saved - self._calls_saved_counted)
+            self._calls_saved_counted = saved
+        round_trip_ms = (after - before) * 1000
+        if self.latency_ms is None:
+            self.latency_ms = round_trip_ms
+        else:
+            self.latency_ms += LATENCY_SMOOTHING * (round_trip_ms - self.latency_ms)
+        # The reported progress is best matched to the middle of the round-trip
+        self.update(playback, (before + after) / 2)
+        return playback
+
+    def update(self, playback, anchor_time):
+        """Feed a snapshot taken at `anchor_time` (monotonic seconds)."""
+        previous = self.playback
+        expected_ms = self.progress_ms(anchor_time) if previous and previous.get('item') else None
+        self.playback = playback
+        self._anchor_time = anchor_time
+
+        if not playback or not playback.get('item'):
+            self._cancel_timer()
+            return
+
+        # A new track, or the same one played again or sought back, is a new track instance
+        if expected_ms is None or previous['item']['uri'] != playback['item']['uri']:
+            self._new_instance()
+            log.info("Now playing: %s", playback['item'].get('name', playback['item']['uri']))
+        elif (playback.get('progress_ms') or 0) < expected_ms - RESTART_TOLERANCE_MS:
+            self._new_instance()
+
+        if not self.is_playing():
+            self._cancel_timer()
+            return
+        self._schedule_trigger()
+
+    def _new_instance(self):
+        self.instance += 1
+        self._fired.clear()
+
+    def is_playing(self):
+        playback = self.playback
+        return bool(playback and playback.get('is_playing') and playback.get('item'))
+
+    def progress_ms(self, now=None):
+        """Predicted progress of the current track, in milliseconds."""
+        if not self.is_playing():
+            return self.playback['progress_ms'] if self.playback and self.playback.get('progress_ms') else 0
+        if now is None:
+            now = self.clock()
+        progress = self.playback['progress_ms'] + (now - self._anchor_time) * 1000
+        return min(progress, self.playback['item']['duration_ms'])
+
+    def remaining_ms(self, now=None):
+        """Predicted time left in the current track, in milliseconds."""
+        if not self.is_playing():
+            return None
+        return self.playback['item']['duration_ms'] - self.progress_ms(now)
+
+    def boundary_remaining_ms(self, now=None):
+        """Predicted time until the next track starts (the crossfade starts), in milliseconds."""
+        remaining = self.remaining_ms(now)
+        return None if remaining is None else max(remaining - self.crossfade_ms, 0)
+
+    def predicted_playback(self, now=None):
+        """The last snapshot with `progress_ms` moved forward to `now`."""
+        if self.playback is None:
+            return None
+        playback = dict(self.playback)
+        playback['progress_ms'] = int(self.progress_ms(now))
+        return playback
+
+    # Trigger timer
+
+    def _pending_target_ms(self):
+        """The largest target of the hooks that haven't run for this track instance, or None."""
+        targets = [self.target_ms(hook) for name, hook in self.hooks.items() if name not in self._fired]
+        return max(targets) if targets else None
+
+    def _schedule_trigger(self):
+        self._cancel_timer()
+        target_ms = self._pending_target_ms()
+        if target_ms is None:
+            return
+        delay = max((self.boundary_remaining_ms() - target_ms) / 1000, 0)
+        self._timer_at = self.clock() + delay
+        self._timer = asyncio.get_running_loop().call_later(delay, self._fire)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _fire(self):
+        self._timer = None
+        if not self.is_playing():
+            return
+        now = self.clock()
+        remaining = self.boundary_remaining_ms(now)
+        playback = self.predicted_playback(now)
+        uri, instance = self.boundary()
+        for name, hook in list(self.hooks.items()):
+            target = self.target_ms(hook)
+            # Hooks with a shorter lead wait for a timer of their own
+            if name in self._fired or remaining > target + 1:
+                continue
+            self._fired.add(name)
+            jitter_ms = target - remaining
+            hook.jitter_ms.append(jitter_ms)
+            BOUNDARY_JITTER_SECONDS.observe(jitter_ms / 1000, hook=name)
+            if len(self._fired) == 1:
+                self.triggers += 1
+            try:
+                hook.callback(playback, {'uri': uri, 'instance': instance, 'target_ms': target, 'jitter_ms': jitter_ms})
+            except Exception as e:
+                log.error("Error in track boundary hook %s: %s", name, e)
+        self._schedule_trigger()
+
+    # Re-sync cadence
+
+    def next_sync_delay(self, now=None):
+        """Seconds until the next snapshot: sparse mid-track, dense near the boundary."""
+        if now is None:
+            now = self.clock()
+        if not self.is_playing():
+            return IDLE_INTERVAL
+
+        remaining = self.boundary_remaining_ms(now) / 1000
+        target_ms = self._pending_target_ms()
+        to_trigger = remaining - (target_ms or 0) / 1000
+
+        if target_ms is None or to_trigger <= NEAR_END_INTERVAL * 1.5:
+            # Let the timer do its work and look again once the next track has started
+            delay = remaining + POST_END_DELAY
+        elif to_trigger > NEAR_END_WINDOW:
+            # Land the next snapshot right at the start of the near-end window
+            delay = min(MAX_SYNC_INTERVAL, to_trigger - NEAR_END_WINDOW)
+        else:
+            delay = NEAR_END_INTERVAL
+        return max(delay, MIN_SYNC_INTERVAL)
+
+    def request_resync(self, delay=0.0):
+        """Ask for a snapshot within `delay` seconds, e.g. right after a zap or play/pause."""
+        at = self.clock() + delay
+        if self._next_sync_at is None or at < self._next_sync_at:
+            self._next_sync_at = at
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        """Tracker loop; runs as a task on the radio's event loop."""
+        if self.started_at is None:  # Kept across restarts, so calls_saved() stays cumulative
+            self.started_at = self.clock()
+        self._wake = asyncio.Event()
+        try:
+            while not self._stopped:
+                self._next_sync_at = None
+                try:
+                    await self.sync()
+                except Exception as e:
+                    log.error("Error monitoring playback: %s", e)
+
+                # Keep any earlier resync requested while the snapshot was in flight
+                planned = self.clock() + self.next_sync_delay()
+                if self._next_sync_at is None or planned < self._next_sync_at:
+                    self._next_sync_at = planned
+                while not self._stopped:
+                    wait = self._next_sync_at - self.clock()
+                    if wait <= 0:
+                        break
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            # Cancelled (the station is stopping or restarting): no boundary hook may fire after this
+            self._cancel_timer()
+
+    def stop(self):
+        self._stopped = True
+        self._cancel_timer()
+        if self._wake is not None:
+            self._wake.set()
+
+    def calls_saved(self):
+        """Snapshots not taken compared to polling `current_playback()` once per second since `run()` started."""
+        elapsed = self.clock() - self.started_at if self.started_at is not None else 0
+        return max(int(elapsed) - self.api_calls, 0)
+
+    def stats(self):
+        """API usage compared to polling `current_playback()` once per second, and each hook's recent jitter."""
+        jitter = {}
+        for name, hook in self.hooks.items():
+            samples = sorted(hook.jitter_ms)
+            if samples:
+                jitter[name] = {'n': len(samples), 'p50': samples[len(samples) // 2],
+                                'max': samples[-1], 'min': samples[0]}
+        return {
+            'api_calls': self.api_calls,
+            'calls_saved': self.calls_saved(),
+            'triggers': self.triggers,
+            'latency_ms': self.latency_ms,
+            'jitter_ms': jitter,
+        }
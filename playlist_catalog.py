@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from channel_registry import atomic_write_json
+from response_cache import CURRENT_USER, cached_call
+from spotify_scheduler import USER, BACKGROUND, get_scheduler
+
+log = logging.getLogger(__name__)
+
+# Folder with one catalogue file per Spotify user
+CATALOG_DIR = 'playlist_catalog'
+
+# Refresh a catalogue in the background once it is older than this (seconds)
+REFRESH_INTERVAL = 300
+
+PAGE_SIZE = 50  # Maximum page size of the Spotify playlists endpoint
+
+
+def _compact(playlist):
+    """Keep only what the panels use from a simplified playlist object."""
+    return {
+        'id': playlist['id'],
+        'uri': playlist['uri'],
+        'name': playlist['name'],
+        'snapshot_id': playlist.get('snapshot_id'),
+        'images': playlist.get('images') or [],
+        'tracks_total': (playlist.get('tracks') or {}).get('total'),
+        'owner': (playlist.get('owner') or {}).get('id'),
+    }
+
+
+class PlaylistCatalog:
+    """On-disk catalogue of one user's playlists, synced incrementally via snapshot_id.
+
+    Page loads read the catalogue; Spotify is only paged through on the first load and
+    then in the background once the catalogue is older than `refresh_interval`. Entries
+    whose snapshot_id is unchanged are kept as they are, and the `etag` only changes when
+    something in the list actually did.
+    """
+
+    def __init__(self, user_id, directory=CATALOG_DIR, refresh_interval=REFRESH_INTERVAL):
+        self.user_id = user_id
+        self.path = os.path.join(directory, f"{user_id}.json")
+        self.refresh_interval = refresh_interval
+        self.order = []
+        self.playlists = {}
+        self.synced_at = 0
+        self.etag = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # Page loads waiting for the first sync share it
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            log.error("Error reading playlist catalogue %s: %s", self.path, e)
+            return
+        self.order = data['order']
+        self.playlists = data['playlists']
+        self.synced_at = data['synced_at']
+        self.etag = data['etag']
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write_json(self.path, {
+            'order': self.order,
+            'playlists': self.playlists,
+            'synced_at': self.synced_at,
+            'etag': self.etag,
+        })
+
+    def items(self):
+        """Playlists in Spotify's order."""
+        with self._lock:
+            return [self.playlists[playlist_id] for playlist_id in self.order]
+
+    def is_stale(self):
+        return time.time() - self.synced_at > self.refresh_interval
+
+    def sync(self, sp):
+        """Page through the user's playlists and merge changes. Returns the number of changed entries."""
+        order = []
+        fetched = {}
+        offset = 0
+        while True:
+            page = get_scheduler().call(BACKGROUND, sp.current_user_playlists, limit=PAGE_SIZE, offset=offset)
+            for playlist in page['items']:
+                if playlist is None:
+                    continue
+                order.append(playlist['id'])
+                fetched[playlist['id']] = playlist
+            if not page.get('next'):
+                break
+            offset += PAGE_SIZE
+
+        with self._lock:
+            playlists = {}
+            changed = 0
+            for playlist_id in order:
+                known = self.playlists.get(playlist_id)
+                playlist = fetched[playlist_id]
+                if known is not None and known['snapshot_id'] == playlist.get('snapshot_id') \
+                        and known['name'] == playlist['name']:
+                    playlists[playlist_id] = known
+                else:
+                    playlists[playlist_id] = _compact(playlist)
+                    changed += 1
+            removed = len(set(self.playlists) - set(playlists))
+            if changed or removed or order != self.order or self.etag is None:
+                self.order = order
+                self.playlists = playlists
+                self.etag = hashlib.sha1(json.dumps(
+                    [(playlist_id, playlists[playlist_id]['snapshot_id'], playlists[playlist_id]['name'])
+                     for playlist_id in order]
+                ).encode()).hexdigest()
+            self.synced_at = time.time()
+            self._save()
+        log.info("Playlist catalogue for %s synced: %d playlists, %d changed, %d removed",
+                 self.user_id, len(order), changed, removed)
+        return changed + removed
+
+    def refresh_in_background(self, sp):
+        """Start a background sync unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.sync(sp)
+            except Exception as e:
+                log.error("Error syncing playlist catalogue: %s", e)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, sp):
+        """The playlists for a page load: synced now if never synced, else refreshed in the background."""
+        if not self.synced_at:
+            with self._sync_lock:
+                if not self.synced_at:
+                    self.sync(sp)
+        elif self.is_stale():
+            self.refresh_in_background(sp)
+        return self.items()
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(user_id):
+    """The shared catalogue for `user_id`."""
+    with _catalogs_lock:
+        if user_id not in _catalogs:
+            _catalogs[user_id] = PlaylistCatalog(user_id)
+        return _catalogs[user_id]
+
+
+def session_catalog(sp, session):
+    """The catalogue for the logged-in Flask session; the user ID is looked up once per session (and token)."""
+    if 'user_id' not in session:
+        session['user_id'] = cached_call(CURRENT_USER, session['token_info']['access_token'], USER, sp.current_user)['id']
+    return get_catalog(session['user_id'])
@@ -1,13 +1,34 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+from flask import Flask, Response, abort, make_response, request, jsonify, render_template, redirect, url_for, session, send_file, stream_with_context
+import hashlib
 import json
+import logging
 import os
-import spotipy
+import queue
+import threading
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
+from spotify_client import session_client
+from channel_registry import ChannelRegistry, atomic_write_json
+from command_bus import CommandQueue
+from command_executor import CommandAllowlist, CommandRejected
+from state_store import StateStore
+from radio_events import EventHub, now_playing_payload
+from response_cache import PLAYBACK, PLAYLIST_ITEMS, cached_call
+from spotify_scheduler import MONITOR, BACKGROUND
+from playlist_catalog import session_catalog
+from art_cache import ArtCache, PLACEHOLDER_SVG, THUMBNAIL_SIZES
+from metrics import REGISTRY, render
+from radio_logging import setup_logging
+from station_config import load_stations
+
+log = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Leveled, rate-limited logging (LOG_LEVEL in .env)
+setup_logging()
+
 # Get Spotify credentials from environment variables
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
@@ -18,13 +39,43 @@ app.secret_key = os.urandom(24)  # A secure random key for session management
 
 # Paths to JSON files
 PLAYLIST_FILE = 'playlists.json'
-COMMAND_FILE = 'command.json'
+
+# Queue of custom commands for the radio
+command_queue = CommandQueue()
+
+# Command templates the radio will run; anything else is turned away when it's queued
+command_allowlist = CommandAllowlist()
+
+# Radio state and history written by radio_control.py
+state_store = StateStore()
+
+# Live radio state published by radio_control.py, fanned out to every /events client
+event_hub = EventHub()
+
+# Stations run by station_manager.py, each with its own channels, command queue, state and events
+stations = load_stations()
+_station_resources = {}
+_station_resources_lock = threading.Lock()
+
+# Seconds between keep-alive comments on idle event streams
+EVENTS_KEEPALIVE = 15
+
+# Thumbnails of playlist covers, served from disk
+art_cache = ArtCache()
+
+# Thumbnails are addressed by snapshot_id, so browsers may keep them for a year
+ART_MAX_AGE = 365 * 24 * 3600
+
+# Playlist items fetched per page for /playlists/<playlist_id>/tracks
+TRACKS_PAGE_SIZE = 100
+TRACK_FIELDS = 'items(track(uri,name,duration_ms,artists(name))),next'
 
 # Spotify OAuth object using credentials from environment variables
 sp_oauth = SpotifyOAuth(client_id=SPOTIPY_CLIENT_ID,
                         client_secret=SPOTIPY_CLIENT_SECRET,
                         redirect_uri=SPOTIPY_REDIRECT_URI,
-                        scope="user-library-read playlist-read-private playlist-modify-public playlist-modify-private")
+                        scope="user-library-read user-read-playback-state playlist-read-private "
+                              "playlist-modify-public playlist-modify-private")
 
 # Load playlists from the JSON file if it exists
 def load_playlists():
@@ -33,61 +84,55 @@ def load_playlists():
             return json.load(file)
     return []
 
-# Save playlists to the JSON file
+# Save playlists to the JSON file (atomically, the radio may be reading it)
 def save_playlists(playlists):
-    with open(PLAYLIST_FILE, 'w') as file:
-        json.dump(playlists, file)
-
-# Load command from the JSON file if it exists
-def load_command():
-    if os.path.exists(COMMAND_FILE):
-        with open(COMMAND_FILE, 'r') as file:
-            data = json.load(file)
-            return data.get('command', None)
-    return None
-
-# Save command to the JSON file
-def save_command(command):
-    with open(COMMAND_FILE, 'w') as file:
-        json.dump({"command": command}, file)
-
-# Clear the command from the JSON file
-def clear_command():
-    with open(COMMAND_FILE, 'w') as file:
-        json.dump({}, file)
+    atomic_write_json(PLAYLIST_FILE, playlists)
 
 # Global list to store radio channels (playlists)
 radio_channels = load_playlists()
 
-# Variable to store the custom command
-custom_command = None
+# A station's channel list, command queue, state and event hub, opened on first use
+def station_resources(name):
+    config = stations.get(name)
+    if config is None:
+        abort(404)
+    with _station_resources_lock:
+        resources = _station_resources.get(name)
+        if resources is None:
+            os.makedirs(config.directory, exist_ok=True)
+            resources = {
+                'config': config,
+                'channels': ChannelRegistry(config.playlists_file),
+                'command_queue': CommandQueue(config.db_file, config.command_socket),
+                'state_store': StateStore(config.db_file),
+                'event_hub': EventHub(config.events_socket),
+            }
+            _station_resources[name] = resources
+        return resources
 
 # Check if the user is logged in by checking session['token_info']
 def is_logged_in():
-    return 'token_info' in session
-
-# Refresh the session token if it's expired
-def refresh_token():
+    # Sessions from before a scope was added (such as user-read-playback-state for /now_playing) log in again
     token_info = session.get('token_info')
-    if sp_oauth.is_token_expired(token_info):
-        print("Token expired, refreshing...")
-        token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-        session['token_info'] = token_info
-    return token_info
+    return token_info is not None and set(sp_oauth.scope.split()) <= set((token_info.get('scope') or '').split())
 
-# Auto-redirect to login if not logged in
+# Get the shared Spotify client for the session, refreshing the token shortly before it expires
+def get_spotify_client():
+    return session_client(sp_oauth, session)
+
+# Auto-redirect to login if not logged in (Prometheus scrapes /metrics without a session)
 @app.before_request
 def require_login():
-    if request.endpoint in ['login', 'callback']:
+    if request.endpoint in ['login', 'callback', 'metrics']:
         return
     if not is_logged_in():
-        print("User not logged in. Redirecting to Spotify login.")
+        log.info("User not logged in. Redirecting to Spotify login.")
         return redirect(url_for('login'))
 
 @app.route('/')
 def index():
     if is_logged_in():
-        print("User already logged in. Redirecting to /playlists.")
+        log.info("User already logged in. Redirecting to /playlists.")
         return redirect(url_for('playlists'))
     return render_template('login.html')
 
@@ -95,10 +140,10 @@ def index():
 def login():
     try:
         auth_url = sp_oauth.get_authorize_url()
-        print(f"Redirecting user to Spotify login: {auth_url}")
+        log.info("Redirecting user to Spotify login: %s", auth_url)
         return redirect(auth_url)
     except Exception as e:
-        print(f"Error generating Spotify login URL: {e}")
+        log.error("Error generating Spotify login URL: %s", e)
         return "Error generating Spotify login URL", 500
 
 @app.route('/callback')
@@ -106,27 +151,91 @@ def callback():
     code = request.args.get('code')
     token_info = sp_oauth.get_access_token(code)
     session['token_info'] = token_info
-    print("Session token info after login:", session['token_info'])
+    log.debug("Logged in, token expires at %s", session['token_info']['expires_at'])
     return redirect(url_for('playlists'))
 
 @app.route('/playlists')
 def playlists():
     if not is_logged_in():
-        print("Token info missing in session. Redirecting to login.")
+        log.info("Token info missing in session. Redirecting to login.")
         return redirect(url_for('index'))
 
-    token_info = refresh_token()
-
-    sp = spotipy.Spotify(auth=token_info['access_token'])
+    sp = get_spotify_client()
 
     try:
-        user_playlists = sp.current_user_playlists(limit=50)['items']
-        print("Playlists fetched successfully!")
+        catalog = session_catalog(sp, session)
+        user_playlists = catalog.get(sp)  # Served from the local catalogue, synced in the background
     except Exception as e:
-        print(f"Error fetching playlists from Spotify: {e}")
+        log.error("Error fetching playlists from Spotify: %s", e)
         return "Error fetching playlists", 500
 
-    return render_template('playlists.html', playlists=user_playlists, selected_playlists=radio_channels, custom_command=custom_command)
+    # The page only changes with the catalogue, the selection or the pending command
+    custom_command = command_queue.peek()
+    etag = hashlib.sha1(json.dumps([catalog.etag, radio_channels, custom_command]).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    response = make_response(render_template('playlists.html', playlists=user_playlists, selected_playlists=radio_channels, custom_command=custom_command))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Cover art thumbnail for a playlist in the catalogue (?size=150 or 300)
+@app.route('/art/<playlist_id>')
+def art(playlist_id):
+    size = request.args.get('size', THUMBNAIL_SIZES[0], type=int)
+    if size not in THUMBNAIL_SIZES:
+        size = THUMBNAIL_SIZES[0]
+
+    path = None
+    try:
+        playlist = session_catalog(get_spotify_client(), session).playlists.get(playlist_id)
+        if playlist:
+            path = art_cache.thumbnail(playlist['images'], size)
+    except Exception as e:
+        log.error("Error fetching cover art for %s: %s", playlist_id, e)
+
+    if path is None:
+        response = Response(PLACEHOLDER_SVG, mimetype='image/svg+xml')
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+        return response
+    return send_file(path, mimetype='image/jpeg', max_age=ART_MAX_AGE)
+
+# What the user's Spotify is playing; screens and phones polling together share one API call
+@app.route('/now_playing')
+def now_playing():
+    sp = get_spotify_client()
+    try:
+        playback = cached_call(PLAYBACK, session['token_info']['access_token'], MONITOR, sp.current_playback)
+    except Exception as e:
+        log.error("Error fetching playback from Spotify: %s", e)
+        return jsonify({"error": "Error fetching playback"}), 500
+    return jsonify(now_playing_payload(playback)), 200
+
+# Tracks of a playlist; served from the response cache, refreshed in the background once stale
+@app.route('/playlists/<playlist_id>/tracks')
+def playlist_tracks(playlist_id):
+    sp = get_spotify_client()
+    token = session['token_info']['access_token']
+    tracks = []
+    offset = 0
+    try:
+        while True:
+            page = cached_call(PLAYLIST_ITEMS, token, BACKGROUND, sp.playlist_items, playlist_id, fields=TRACK_FIELDS,
+                               limit=TRACKS_PAGE_SIZE, offset=offset, additional_types=('track',))
+            tracks.extend({
+                'uri': item['track']['uri'],
+                'name': item['track']['name'],
+                'artists': [artist['name'] for artist in item['track'].get('artists', [])],
+                'duration_ms': item['track']['duration_ms'],
+            } for item in page['items'] if item.get('track'))
+            if not page.get('next'):
+                break
+            offset += TRACKS_PAGE_SIZE
+    except Exception as e:
+        log.error("Error fetching tracks of %s from Spotify: %s", playlist_id, e)
+        return jsonify({"error": "Error fetching tracks"}), 500
+    return jsonify({"tracks": tracks}), 200
 
 @app.route('/set_playlists', methods=['POST'])
 def set_playlists():
@@ -136,7 +245,7 @@ def set_playlists():
     if 'playlists' in data:
         radio_channels = data['playlists']
         save_playlists(radio_channels)
-        print(f"Received playlists: {radio_channels}")
+        log.info("Received playlists: %s", radio_channels)
         return jsonify({"message": "Playlists updated successfully!"}), 200
     else:
         return jsonify({"error": "No playlists provided"}), 400
@@ -151,21 +260,143 @@ def set_command():
     if not is_logged_in():
         return redirect(url_for('login'))  # Redirect to login if not authenticated
 
-    global custom_command
     data = request.form
     custom_command = data.get('command')  # Get the command from the input field
-    save_command(custom_command)  # Save the command to JSON file
-    print(f"Send command: {custom_command}")  # Log when a command is set
-    return jsonify({"message": "Command set successfully!"}), 200
+    if not custom_command:
+        return jsonify({"error": "No command provided"}), 400
+    try:
+        command_allowlist.resolve(custom_command)
+    except CommandRejected as e:
+        return jsonify({"error": str(e)}), 400
+    command_id = command_queue.enqueue(custom_command)  # Queue the command and notify the radio
+    event_hub.publish('command_queued', {'id': command_id, 'command': custom_command})
+    log.info("Send command: %s", custom_command)  # Log when a command is set
+    return jsonify({"message": "Command set successfully!", "id": command_id}), 200
 
-# Route for the radio to fetch the latest command from JSON
+# Route for fetching the next queued command
 @app.route('/get_command', methods=['GET'])
 def get_command():
-    global custom_command
-    custom_command = load_command()
+    custom_command = command_queue.peek()
     if custom_command:
-        return jsonify({"command": custom_command}), 200
+        return jsonify({"command": custom_command, "queue": [command for _, command in command_queue.pending()]}), 200
     return jsonify({"message": "No command available"}), 404
 
+# Route for the latest commands with their status and the tail of their output (live output is on /events)
+@app.route('/commands', methods=['GET'])
+def commands():
+    return jsonify({"commands": command_queue.recent(request.args.get('limit', 20, type=int)),
+                    "templates": sorted(command_allowlist.templates)}), 200
+
+# Route for what the radio played recently (default: the last hour) and its station breaks
+@app.route('/history', methods=['GET'])
+def history():
+    seconds = request.args.get('seconds', 3600, type=int)
+    return jsonify({
+        "current_channel": state_store.get('current_channel'),
+        "plays": state_store.recent_plays(seconds),
+        "breaks": state_store.recent_breaks(),
+    }), 200
+
+# Prometheus metrics of the panel and (as last pushed) the radio
+@app.route('/metrics')
+def metrics():
+    families = REGISTRY.collect(process='panel') + (state_store.get('metrics') or [])
+    return Response(render(families), mimetype='text/plain; version=0.0.4')
+
+# Server-Sent Events stream of a hub's events
+def event_stream(hub):
+    hub.start()  # Bound lazily so only the serving process owns the socket
+    subscriber = hub.subscribe()
+
+    def stream():
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Server-Sent Events stream of now-playing, progress, channel, command and jingle events
+@app.route('/events')
+def events():
+    return event_stream(event_hub)
+
+# Stations run by station_manager.py, with what each is playing
+@app.route('/stations', methods=['GET'])
+def list_stations():
+    listing = []
+    for name, config in stations.items():
+        state_store = station_resources(name)['state_store']
+        listing.append({"name": name, "device": config.device_name,
+                        "current_channel": state_store.get('current_channel'), "playing": state_store.get('playing')})
+    return jsonify({"stations": listing}), 200
+
+# A station's channels (playlist URIs)
+@app.route('/stations/<name>/playlists', methods=['GET', 'POST'])
+def station_playlists(name):
+    resources = station_resources(name)
+    if request.method == 'GET':
+        return jsonify({"playlists": resources['channels'].channels()}), 200
+
+    data = request.get_json()
+    if not data or 'playlists' not in data:
+        return jsonify({"error": "No playlists provided"}), 400
+    atomic_write_json(resources['config'].playlists_file, data['playlists'])
+    log.info("Received playlists for station %s: %s", name, data['playlists'])
+    return jsonify({"message": "Playlists updated successfully!"}), 200
+
+# A station's command queue: queue a command (form field `command`) or look at what's queued
+@app.route('/stations/<name>/command', methods=['GET', 'POST'])
+def station_command(name):
+    resources = station_resources(name)
+    command_queue = resources['command_queue']
+    if request.method == 'GET':
+        custom_command = command_queue.peek()
+        if custom_command:
+            return jsonify({"command": custom_command, "queue": [command for _, command in command_queue.pending()]}), 200
+        return jsonify({"message": "No command available"}), 404
+
+    custom_command = request.form.get('command')
+    if not custom_command:
+        return jsonify({"error": "No command provided"}), 400
+    try:
+        command_allowlist.resolve(custom_command)
+    except CommandRejected as e:
+        return jsonify({"error": str(e)}), 400
+    command_id = command_queue.enqueue(custom_command)
+    resources['event_hub'].publish('command_queued', {'id': command_id, 'command': custom_command})
+    log.info("Send command to station %s: %s", name, custom_command)
+    return jsonify({"message": "Command set successfully!", "id": command_id}), 200
+
+# A station's latest commands with their status and output
+@app.route('/stations/<name>/commands', methods=['GET'])
+def station_commands(name):
+    command_queue = station_resources(name)['command_queue']
+    return jsonify({"commands": command_queue.recent(request.args.get('limit', 20, type=int)),
+                    "templates": sorted(command_allowlist.templates)}), 200
+
+# What a station played recently (default: the last hour) and its station breaks
+@app.route('/stations/<name>/history', methods=['GET'])
+def station_history(name):
+    state_store = station_resources(name)['state_store']
+    seconds = request.args.get('seconds', 3600, type=int)
+    return jsonify({
+        "current_channel": state_store.get('current_channel'),
+        "plays": state_store.recent_plays(seconds),
+        "breaks": state_store.recent_breaks(),
+    }), 200
+
+# Server-Sent Events stream of one station
+@app.route('/stations/<name>/events')
+def station_events(name):
+    return event_stream(station_resources(name)['event_hub'])
+
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
@@ -0,0 +1,478 @@
+import asyncio
+import logging
+import time
+
+import spotipy
+
+from playback_tracker import PlaybackTracker
+from device_cache import DeviceCache, call_with_backoff
+from channel_prefetch import ChannelPrefetcher
+from station_break import StationBreakWorker
+from radio_events import now_playing_payload
+from shuffle_engine import ShuffleEngine
+from state_store import StateStore
+from metrics import REGISTRY, Histogram
+from spotify_scheduler import USER, MONITOR, BACKGROUND, get_scheduler
+
+log = logging.getLogger(__name__)
+
+# Spotify calls that take longer than this are abandoned (seconds)
+SPOTIFY_TIMEOUT = 10
+
+# Seconds between locally predicted progress updates sent to the web panel
+PROGRESS_EVENT_INTERVAL = 5
+
+# Playlist items fetched per page when loading a channel's tracks
+TRACKS_PAGE_SIZE = 100
+TRACK_FIELDS = 'items(track(uri)),next'
+
+# Tracks left with less than this to go aren't resumed when returning to a channel (milliseconds)
+RESUME_MIN_REMAINING_MS = 5000
+
+# A track resumed after a break this far behind where it was paused is sought back (milliseconds)
+RESUME_DRIFT_MS = 2000
+
+# Seconds between pushes of the radio's metrics to the state store, for the panel's /metrics
+METRICS_PUSH_INTERVAL = 15
+
+ZAP_LATENCY_SECONDS = Histogram('zap_latency_seconds', 'Key press to playback started on the new channel')
+TRIGGER_ERROR_SECONDS = Histogram('pre_end_trigger_error_seconds',
+                                  'How late (positive) or early the pre-end trigger fired',
+                                  buckets=(-1.0, -0.5, -0.25, -0.1, -0.05, -0.01, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+# How often to look at the command queue when socket notifications are unavailable (seconds)
+COMMAND_POLL_INTERVAL = 5
+
+
+class RadioStation:
+    """The radio's control core: Spotify calls, playback tracking, key events and station breaks
+    all run as tasks on one asyncio event loop.
+
+    Spotify calls go through the shared `SpotifyScheduler`, reusing the shared connection
+    pool. Playback-changing calls are user priority and serial, so they reach Spotify in
+    the order they were made and pre-empt snapshots and prefetching; a call still waiting
+    for its turn is dropped when its task is cancelled, which is how a new zap cancels
+    the previous one.
+
+    `name` tells stations sharing the process (and the scheduler) apart; `device_name`
+    picks the playback device by name instead of the active one. Station breaks start
+    `trigger_lead_ms` before each track boundary; set `crossfade_ms` to the player's
+    crossfade so they aren't late. Displays, jingles and commands can add their own
+    boundary hooks with `tracker.add_hook()`.
+    """
+
+    def __init__(self, sp, channel_registry, command_queue, events, jingle_bank, display,
+                 resume_lead_ms=None, spotify_timeout=SPOTIFY_TIMEOUT, scheduler=None, shuffle=None, store=None,
+                 name=None, device_name=None, trigger_lead_ms=None, crossfade_ms=0, executor=None):
+        self.name = name
+        self.sp = sp
+        self.scheduler = scheduler or get_scheduler()
+        self.channel_registry = channel_registry
+        self.store = store or StateStore()  # Current channel, play log and break history
+        self.command_queue = command_queue
+        self.events = events
+        self.display = display
+        self.spotify_timeout = spotify_timeout
+
+        self.current_channel = 0  # Current channel index
+        self.custom_command = None  # Command currently being handled
+
+        self.device_cache = DeviceCache(device_name)  # Cached playback device and shuffle state
+        tracker_options = {} if trigger_lead_ms is None else {'lead_ms': trigger_lead_ms}
+        self.tracker = PlaybackTracker(self.fetch_playback, crossfade_ms=crossfade_ms, **tracker_options)
+        self.tracker.add_hook('station_break', self.on_song_about_to_end)
+        self.shuffle = shuffle or ShuffleEngine(self.store)  # Our own shuffle order and play history per channel
+        # Metadata and track lists for the neighbouring channels
+        self.prefetcher = ChannelPrefetcher(self.fetch_playlist, fetch_tracks=self.fetch_track_uris,
+                                            shuffle=self.shuffle)
+        break_options = {} if resume_lead_ms is None else {'resume_lead_ms': resume_lead_ms}
+        self.station_breaks = StationBreakWorker(jingle_bank, self.pause_for_break, self.resume_after_break,
+                                                 display, executor=executor, publish=events.publish, **break_options)
+
+        self._zap_task = None
+        self._playing_channel = None  # Playlist URI we last started
+        self._playing_track = None  # Track URI last seen playing
+        self._resumed_from = None  # Where the last station break paused, until checked against a snapshot
+        self._snapshot_ready = None  # asyncio.Event, created on the loop at first use
+        self._started = False  # run() has been called before (a restart after a crash)
+
+    @property
+    def snapshot_ready(self):
+        """Event set once the first playback snapshot is in."""
+        if self._snapshot_ready is None:
+            self._snapshot_ready = asyncio.Event()
+        return self._snapshot_ready
+
+    # Spotify calls
+
+    async def call(self, priority, fn, *args, **kwargs):
+        """Run a (blocking) spotipy call through the scheduler, with a timeout."""
+        return await asyncio.wait_for(self.scheduler.run(priority, fn, *args, owner=self.name, **kwargs),
+                                      self.spotify_timeout)
+
+    async def control(self, fn, *args, **kwargs):
+        """Run a playback-changing spotipy call: user priority, in order with the others."""
+        return await self.call(USER, fn, *args, serial=True, **kwargs)
+
+    async def fetch_playback(self):
+        """Playback snapshot for the tracker, keeping the device cache up to date on the way."""
+        playback = await self.call(MONITOR, self.sp.current_playback)
+        self.device_cache.observe(playback)
+        self.observe_track(playback)
+        self.check_resume(playback)
+        self.events.publish('now_playing', now_playing_payload(playback))
+        self.snapshot_ready.set()
+        return playback
+
+    async def fetch_playlist(self, playlist_uri, fields=None):
+        return await self.call(BACKGROUND, self.sp.playlist, playlist_uri, fields=fields)
+
+    async def fetch_track_uris(self, playlist_uri):
+        """Every track URI in the playlist, page by page."""
+        uris = []
+        offset = 0
+        while True:
+            page = await self.call(BACKGROUND, self.sp.playlist_items, playlist_uri, fields=TRACK_FIELDS,
+                                   limit=TRACKS_PAGE_SIZE, offset=offset, additional_types=('track',))
+            uris.extend(item['track']['uri'] for item in page['items'] if item.get('track'))
+            if not page.get('next'):
+                return uris
+            offset += TRACKS_PAGE_SIZE
+
+    # Channels
+
+    def load_playlists(self):
+        """The playlists; the registry only re-reads the JSON file when it changes."""
+        return self.channel_registry.channels()
+
+    async def start_channel_playback(self, playlist_uri, offset=None, uris=None, position_ms=None):
+        """Start a playlist on the cached device; a 404 means the device went away, so look it up once more.
+
+        With `uris` the tracks are played in the given order, with Spotify's shuffle off.
+        """
+        for attempt in range(2):
+            device_id = await self.device_cache.device_id(lambda: self.control(self.sp.devices))
+            if device_id is None:
+                return None
+            try:
+                await self.device_cache.ensure_shuffle(
+                    lambda state, device_id: self.control(self.sp.shuffle, state, device_id=device_id),
+                    device_id, uris is None)
+                if uris is None:
+                    await call_with_backoff(lambda: self.control(
+                        self.sp.start_playback, device_id=device_id, context_uri=playlist_uri, offset=offset))
+                else:
+                    await call_with_backoff(lambda: self.control(
+                        self.sp.start_playback, device_id=device_id, uris=uris, position_ms=position_ms))
+                return device_id
+            except spotipy.SpotifyException as e:
+                self.device_cache.invalidate()
+                if e.http_status != 404 or attempt == 1:
+                    raise
+
+    async def play_channel(self, channel_index, zap_started_at=None):
+        """Play the channel (playlist) at `channel_index`."""
+        if zap_started_at is None:
+            zap_started_at = time.monotonic()
+
+        radio_channels = self.load_playlists()
+        if not radio_channels:
+            log.warning("No playlists available. Please set some playlists.")
+            return
+
+        playlist_uri = radio_channels[channel_index]
+
+        # Prefetched channels show their name right away and start at a pre-picked random track,
+        # or better, the next tracks of our own shuffle once their track list is loaded
+        info = self.prefetcher.take(playlist_uri)
+        offset = None
+        if info is not None:
+            self.display(f"Channel {channel_index + 1}: {info['name']}")
+            if info['track_count']:
+                offset = {'position': info['start_offset']}
+        else:
+            self.prefetcher.prefetch(playlist_uri)
+        window = self.shuffle.next_window(playlist_uri)
+        uris, position_ms = window if window else (None, None)
+
+        try:
+            device_id = await self.start_channel_playback(playlist_uri, offset, uris, position_ms)
+        except Exception as e:
+            log.error("Error starting playback: %r", e)
+            return
+
+        if device_id is None:
+            log.warning("No active devices found!")
+            return
+
+        self._playing_channel = playlist_uri
+        self.store.set('current_channel', {'index': channel_index, 'uri': playlist_uri})
+        latency_ms = (time.monotonic() - zap_started_at) * 1000
+        ZAP_LATENCY_SECONDS.observe(latency_ms / 1000)
+        log.info("Playing (shuffled) playlist: %s on device: %s | Zap latency: %.0f ms",
+                 playlist_uri, device_id, latency_ms, extra={'rate_limit': False})
+        self.resync_playback()
+        self.events.publish('channel', {'index': channel_index, 'uri': playlist_uri,
+                                        'name': info['name'] if info else None})
+        self.prefetcher.warm(radio_channels, channel_index)
+
+    def preview_channel(self, channel_index):
+        """Show the channel `channel_index` would land on, without touching playback."""
+        radio_channels = self.load_playlists()
+        if not radio_channels:
+            return
+        channel_index %= len(radio_channels)
+        info = self.prefetcher.get(radio_channels[channel_index])
+        self.display(f"Channel {channel_index + 1}: {info['name']}" if info else f"Channel {channel_index + 1}")
+
+    def zap_by(self, steps, zap_started_at=None):
+        """Zap `steps` channels ahead; a zap still in flight is cancelled."""
+        if zap_started_at is None:
+            zap_started_at = time.monotonic()
+        radio_channels = self.load_playlists()
+        if len(radio_channels) == 0:
+            log.warning("No playlists available. Please set some playlists.")
+            return
+
+        self.leave_channel()
+        self.current_channel = (self.current_channel + steps) % len(radio_channels)
+        log.info("Zapping to channel %d", self.current_channel, extra={'rate_limit': False})
+        if self._zap_task is not None and not self._zap_task.done():
+            self._zap_task.cancel()
+        self._zap_task = asyncio.ensure_future(self.play_channel(self.current_channel, zap_started_at))
+
+    def zap_next_channel(self):
+        """Zap to the next channel."""
+        self.zap_by(1)
+
+    async def play_pause(self):
+        """Toggle play/pause for the current channel."""
+        playback = await self.call(USER, self.sp.current_playback)
+        log.debug("Playback state: %s", playback and {key: playback.get(key) for key in ('is_playing', 'progress_ms')})
+
+        if playback is None or playback['item'] is None:
+            log.info("No current playback. Starting channel %d.", self.current_channel)
+            await self.play_channel(self.current_channel)
+        else:
+            if playback['is_playing']:
+                await self.control(self.sp.pause_playback)
+                log.info("Playback paused.")
+            else:
+                await self.control(self.sp.start_playback)
+                log.info("Playback resumed.")
+            self.resync_playback()
+
+    def toggle_play_pause(self):
+        asyncio.ensure_future(self._guard(self.play_pause()))
+
+    @staticmethod
+    async def _guard(coroutine):
+        try:
+            await coroutine
+        except Exception as e:
+            log.error("Error handling key press: %r", e)
+
+    # Shuffle
+
+    def observe_track(self, playback):
+        """Record each new track in the play log and the channel's shuffle history."""
+        item = playback.get('item') if playback else None
+        if item is None or item['uri'] == self._playing_track:
+            return
+        self._playing_track = item['uri']
+        self.store.track_started(item['uri'], item.get('name'), self._playing_channel)
+        self.store.set('playing', {'track_uri': item['uri'], 'channel_uri': self._playing_channel})
+        if self._playing_channel is not None:
+            self.shuffle.played(self._playing_channel, item['uri'])
+
+    def leave_channel(self):
+        """Remember where the channel was, so returning to it resumes the track (unless it was nearly over)."""
+        if self._playing_channel is not None and self.tracker.is_playing() \
+                and self.tracker.remaining_ms() > RESUME_MIN_REMAINING_MS:
+            playback = self.tracker.predicted_playback()
+            self.shuffle.leave(self._playing_channel, playback['item']['uri'], playback['progress_ms'])
+
+    async def continue_channel(self):
+        """Start the next window of the channel's shuffle once the current one has played out."""
+        if self._playing_channel is not None and self.shuffle.window_exhausted(self._playing_channel):
+            await asyncio.sleep((self.tracker.remaining_ms() or 0) / 1000)
+            await self.play_channel(self.current_channel)
+
+    # Station breaks
+
+    async def pause_for_break(self):
+        """Pause for a station break; returns where playback was (from the tracker, no extra call)."""
+        snapshot = None
+        if self.tracker.is_playing():
+            playback = self.tracker.predicted_playback()
+            snapshot = {
+                'channel': self.current_channel,
+                'device_id': (playback.get('device') or {}).get('id'),
+                'context_uri': (playback.get('context') or {}).get('uri'),
+                'track_uri': playback['item']['uri'],
+                'progress_ms': playback['progress_ms'],
+            }
+        self.leave_channel()
+        await self.control(self.sp.pause_playback)
+        return snapshot
+
+    async def resume_after_break(self, snapshot=None):
+        """Resume the interrupted track in place once the jingle has ended; restart the channel only if that fails."""
+        if snapshot is None:
+            await self.play_channel(self.current_channel)
+            return
+        if snapshot['channel'] != self.current_channel:
+            return  # Zapped during the break; the new channel is already playing
+        try:
+            await self.control(self.sp.start_playback, device_id=snapshot['device_id'])
+        except Exception as e:
+            log.warning("Error resuming playback, restarting the channel: %r", e)
+            self.device_cache.invalidate()
+            await self.play_channel(self.current_channel)
+            return
+        self._resumed_from = snapshot
+        self.resync_playback()
+        # The break took this track's boundary; if it ends the shuffle window, start the next one after it
+        if self._playing_channel is not None and self.shuffle.window_exhausted(self._playing_channel):
+            asyncio.ensure_future(self._guard(self.continue_channel()))
+
+    def check_resume(self, playback):
+        """Compare the first snapshot after a break with where we paused, and correct any drift."""
+        snapshot, self._resumed_from = self._resumed_from, None
+        if snapshot is None or not playback or not playback.get('item'):
+            return
+        context_uri = (playback.get('context') or {}).get('uri')
+        if context_uri != snapshot['context_uri']:
+            log.warning("Playback moved to another context during the break, restarting the channel.")
+            asyncio.ensure_future(self._guard(self.play_channel(self.current_channel)))
+        elif playback['item']['uri'] == snapshot['track_uri'] \
+                and playback['progress_ms'] < snapshot['progress_ms'] - RESUME_DRIFT_MS:
+            log.warning("Resumed at %d ms instead of %d ms, seeking back.", playback['progress_ms'], snapshot['progress_ms'])
+            asyncio.ensure_future(self._guard(self.control(
+                self.sp.seek_track, snapshot['progress_ms'], device_id=snapshot['device_id'])))
+            self.resync_playback()
+
+    async def load_command(self):
+        """Take the next command from the queue; returns (command_id, command) or None."""
+        claimed = await asyncio.get_running_loop().run_in_executor(None, self.command_queue.claim)
+        self.custom_command = claimed[1] if claimed else None
+        if claimed:
+            log.info("Loaded command from queue: %s", self.custom_command)
+        return claimed
+
+    def play_jingle_and_execute_command(self, claimed):
+        """Hand the command to the station-break worker: jingle, resume the playlist, then run the command."""
+        command_id, command = claimed
+        log.info("Received custom command: %s", command)
+        self.store.break_started(command_id, command)
+
+        # Acknowledge the command once it has actually run
+        def on_done(returncode, output):
+            status = 'done' if returncode == 0 else 'failed'
+            self.command_queue.ack(command_id, result=(output or '')[-1000:], status=status)
+            gaps_ms = self.station_breaks.gaps_ms
+            self.store.break_finished(command_id, returncode,
+                                      gaps_ms[-1] if returncode is not None and gaps_ms else None)
+            self.events.publish('command_executed', {'id': command_id, 'command': command, 'returncode': returncode})
+
+        self.station_breaks.submit(command, on_done, command_id)
+        self.custom_command = None  # The worker owns the command now
+
+    async def fetch_and_display_command(self, playback=None):
+        """Fetch and display the next command when the song is about to end, then start the break."""
+        claimed = await self.load_command()
+        if claimed:
+            command = claimed[1]
+            if playback and playback['is_playing']:
+                log.debug("Command to be shown: %s | Song progress: %d ms", command, playback['progress_ms'])
+            self.display(f"Command: {command}")
+            self.play_jingle_and_execute_command(claimed)
+        else:
+            await self.continue_channel()
+
+    def on_song_about_to_end(self, playback, boundary):
+        """Boundary hook: runs once per track instance, the trigger lead (1 second) before the next track starts."""
+        log.debug("Song is about to end.")
+        error_ms = boundary['jitter_ms']
+        TRIGGER_ERROR_SECONDS.observe(error_ms / 1000)
+        self.store.track_triggered(error_ms)
+        asyncio.ensure_future(self._guard(self.fetch_and_display_command(playback)))
+
+    # Background tasks
+
+    async def watch_commands(self):
+        """Show new commands as soon as the web panel queues them; they run at the next song end."""
+        loop = asyncio.get_running_loop()
+        notified = asyncio.Event()
+        if self.command_queue.listen():
+            loop.add_reader(self.command_queue.fileno(), lambda: self.command_queue.drain() and notified.set())
+        while True:
+            try:
+                await asyncio.wait_for(notified.wait(), COMMAND_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            notified.clear()
+            command = await loop.run_in_executor(None, self.command_queue.peek)
+            if command:
+                self.display(f"Next command: {command}")
+
+    async def publish_progress(self):
+        """Publish the tracker's predicted progress; costs no Spotify calls."""
+        while True:
+            await asyncio.sleep(PROGRESS_EVENT_INTERVAL)
+            if self.tracker.is_playing():
+                playback = self.tracker.predicted_playback()
+                self.events.publish('progress', {'uri': playback['item']['uri'],
+                                                 'progress_ms': playback['progress_ms'],
+                                                 'duration_ms': playback['item']['duration_ms']})
+
+    async def publish_metrics(self):
+        """Hand the radio's metrics to the web panel through the state store."""
+        while True:
+            await asyncio.sleep(METRICS_PUSH_INTERVAL)
+            self.store.set('metrics', REGISTRY.collect(process='radio'))
+
+    def restore_state(self):
+        """Pick up the channel and track from the last run, for a warm restart."""
+        radio_channels = self.load_playlists()
+        saved = self.store.get('current_channel')
+        if saved and saved['uri'] in radio_channels:
+            self.current_channel = radio_channels.index(saved['uri'])
+            log.info("Restored channel %d.", self.current_channel + 1)
+        playing = self.store.get('playing')
+        if playing:
+            # The same track still playing is not a new play
+            self._playing_track = playing['track_uri']
+            self._playing_channel = playing['channel_uri']
+
+    def resync_playback(self):
+        """Ask the tracker for a fresh snapshot after we changed playback ourselves."""
+        self.tracker.request_resync(delay=0.5)
+
+    async def run(self):
+        """Run the station until cancelled. If one of its tasks fails, the others are stopped and the error raised."""
+        loop = asyncio.get_running_loop()
+        self.store.start()
+        if not self._started:
+            # Only at first start: after a restart, the break worker may still be running these
+            self._started = True
+            requeued = await loop.run_in_executor(None, self.command_queue.requeue_unacked)
+            if requeued:
+                log.info("Requeued %d unfinished command(s).", requeued)
+        await loop.run_in_executor(None, self.restore_state)
+        self.prefetcher.warm(self.load_playlists(), self.current_channel)
+
+        log.info("Starting playback monitor in the background...")
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in (
+            self.tracker.run(),
+            self.station_breaks.run(),
+            self.watch_commands(),
+            self.publish_progress(),
+            self.publish_metrics(),
+        )]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Most frames pushed to the display per second; slow buses get no more than this
+REFRESH_HZ = 10
+
+# Seconds between scroll steps of a message too long for the display, and steps to pause on its start
+SCROLL_INTERVAL = 0.35
+SCROLL_PAUSE_STEPS = 4
+SCROLL_GAP = '   '  # Between the end of a scrolling message and its start
+
+# Unchanged cells between two changed runs up to which the runs are sent as one (a cursor move costs about as much)
+MERGE_GAP = 2
+
+# Seconds between progress indicator updates
+PROGRESS_INTERVAL = 1.0
+
+
+def diff_frames(old, new, merge_gap=MERGE_GAP):
+    """Runs of changed cells between two frames (lists of equal-width rows), as (row, col, text)."""
+    runs = []
+    for row, after in enumerate(new):
+        before = old[row] if old is not None and row < len(old) else None
+        if before is None:
+            runs.append((row, 0, after))
+            continue
+        start = end = None
+        for col, (a, b) in enumerate(zip(before, after)):
+            if a == b:
+                continue
+            if start is not None and col - end > merge_gap:
+                runs.append((row, start, after[start:end]))
+                start = None
+            if start is None:
+                start = col
+            end = col + 1
+        if start is not None:
+            runs.append((row, start, after[start:end]))
+    return runs
+
+
+def format_time(ms):
+    seconds = int(ms // 1000)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class FramebufferBackend:
+    """Simulated character display: the cells live in memory and bus traffic is counted.
+
+    `seconds_per_cell` makes writes as slow as a real bus (an I2C character LCD takes
+    about half a millisecond per cell), for trying out refresh budgets without hardware.
+    """
+
+    def __init__(self, cols=16, rows=2, seconds_per_cell=0.0):
+        self.cols = cols
+        self.rows = rows
+        self.seconds_per_cell = seconds_per_cell
+        self.cells = [[' '] * cols for _ in range(rows)]
+        self.writes = 0  # Cursor moves, one per run of cells
+        self.cells_written = 0
+        self.frames = 0
+
+    def write(self, row, col, text):
+        self.cells[row][col:col + len(text)] = list(text)
+        self.writes += 1
+        self.cells_written += len(text)
+        if self.seconds_per_cell:
+            time.sleep(self.seconds_per_cell * len(text))
+
+    def flush(self):
+        self.frames += 1
+
+    def close(self):
+        pass
+
+    def text(self):
+        return [''.join(row) for row in self.cells]
+
+
+class ConsoleBackend(FramebufferBackend):
+    """Prints the display's first row whenever it changes, like the old `print()` placeholder."""
+
+    def __init__(self, cols=160, rows=1):
+        super().__init__(cols, rows)
+
+    def flush(self):
+        super().flush()
+        print(f"Radio Display: {self.text()[0].rstrip()}")
+
+
+class CharacterLcdBackend:
+    """HD44780 character LCD behind a PCF8574 I2C backpack, driven in 4-bit mode.
+
+    Needs `smbus2`, imported only when this backend is used.
+    """
+
+    ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+    # PCF8574 pins
+    REGISTER_SELECT = 0x01
+    ENABLE = 0x04
+    BACKLIGHT = 0x08
+
+    def __init__(self, cols=16, rows=2, address=0x27, bus=1):
+        from smbus2 import SMBus
+
+        self.cols = cols
+        self.rows = rows
+        self.address = address
+        self._bus = SMBus(bus)
+        # Power-on reset into 4-bit mode, then two lines, display on without cursor, left to right, clear
+        time.sleep(0.05)
+        for nibble, delay in ((0x30, 0.0045), (0x30, 0.0045), (0x30, 0.00015), (0x20, 0.00015)):
+            self._write_nibble(nibble)
+            time.sleep(delay)
+        for command in (0x28, 0x0C, 0x06, 0x01):
+            self._send(command, 0)
+        time.sleep(0.002)
+
+    def _write_nibble(self, bits):
+        bits |= self.BACKLIGHT
+        self._bus.write_byte(self.address, bits | self.ENABLE)
+        self._bus.write_byte(self.address, bits & ~self.ENABLE)
+
+    def _send(self, value, mode):
+        self._write_nibble(mode | (value & 0xF0))
+        self._write_nibble(mode | ((value << 4) & 0xF0))
+
+    def write(self, row, col, text):
+        self._send(0x80 | (self.ROW_OFFSETS[row] + col), 0)
+        for char in text:
+            code = ord(char)
+            self._send(code if 32 <= code < 127 else ord('?'), self.REGISTER_SELECT)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._send(0x01, 0)
+        self._bus.close()
+
+
+class RadioDisplay:
+    """Render pipeline between the radio and a (slow) display backend.
+
+    `show(message)` (also `display(message)`) and `progress()` only record what should be
+    on screen and return at once; a render thread composes frames, scrolls messages that
+    don't fit and pushes just the cells that changed, at most `refresh_hz` frames a second.
+    Messages shown faster than that are coalesced, so a burst of zaps costs one frame.
+    The message goes on the first row, the track's elapsed time and a progress bar on
+    the last (on displays with more than one row).
+    """
+
+    def __init__(self, backend, refresh_hz=REFRESH_HZ, scroll_interval=SCROLL_INTERVAL, clock=time.monotonic):
+        self.backend = backend
+        self.cols = backend.cols
+        self.rows = backend.rows
+        self.frame_interval = 1 / refresh_hz
+        self.scroll_interval = scroll_interval
+        self.clock = clock
+
+        self._message = ''
+        self._message_at = 0.0  # When the message was shown, for scrolling
+        self._progress = None  # (elapsed_ms, duration_ms)
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pushed = None  # Last frame on the display
+        self._pushed_at = 0.0
+
+        self.frames = 0
+        self.runs = 0
+        self.cells_written = 0
+        self.coalesced = 0
+
+    # Called from the radio; never blocks on the display
+
+    def show(self, message):
+        with self._lock:
+            if self._dirty.is_set():
+                self.coalesced += 1
+            self._message = ' '.join(str(message).split())
+            self._message_at = self.clock()
+        self._dirty.set()
+
+    __call__ = show
+
+    def progress(self, elapsed_ms, duration_ms):
+        """Set the progress indicator (None to clear it); only the cells that change are sent."""
+        with self._lock:
+            self._progress = None if elapsed_ms is None else (elapsed_ms, duration_ms)
+        self._dirty.set()
+
+    # Rendering
+
+    def _scroll_offset(self, text, now):
+        if len(text) <= self.cols:
+            return None
+        steps = int((now - self._message_at) / self.scroll_interval)
+        return max(steps - SCROLL_PAUSE_STEPS, 0) % (len(text) + len(SCROLL_GAP))
+
+    def compose(self, now=None):
+        """The frame to show at `now`, as a list of rows exactly `cols` wide."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            message, progress = self._message, self._progress
+        offset = self._scroll_offset(message, now)
+        if offset is not None:
+            looped = message + SCROLL_GAP + message
+            message = looped[offset:offset + self.cols]
+        frame = [message.ljust(self.cols)[:self.cols]]
+        if self.rows > 1:
+            frame += [''.ljust(self.cols)] * (self.rows - 2)
+            frame.append(self._progress_row(progress))
+        return frame
+
+    def _progress_row(self, progress):
+        if progress is None:
+            return ' ' * self.cols
+        elapsed_ms, duration_ms = progress
+        label = format_time(elapsed_ms) + ' '
+        width = self.cols - len(label)
+        filled = int(width * min(elapsed_ms / duration_ms, 1)) if duration_ms else 0
+        return (label + '#' * filled + '-' * (width - filled))[:self.cols]
+
+    def _next_wakeup(self, now):
+        """Seconds until the next scroll step, or None when nothing is scrolling."""
+        with self._lock:
+            scrolling = len(self._message) > self.cols
+            elapsed = now - self._message_at
+        if not scrolling:
+            return None
+        return self.scroll_interval - elapsed % self.scroll_interval
+
+    def render(self):
+        """Compose a frame and push whatever changed; returns the number of cells written."""
+        frame = self.compose()
+        runs = diff_frames(self._pushed, frame)
+        cells = 0
+        if runs:
+            for row, col, text in runs:
+                self.backend.write(row, col, text)
+                cells += len(text)
+            self.backend.flush()
+            self.frames += 1
+            self.runs += len(runs)
+            self.cells_written += cells
+        self._pushed = frame
+        return cells
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._dirty.wait(self._next_wakeup(self.clock()))
+            # Stay within the refresh budget; anything shown meanwhile lands in the same frame
+            wait = self._pushed_at + self.frame_interval - self.clock()
+            if wait > 0 and self._stop.wait(wait):
+                return
+            self._dirty.clear()
+            try:
+                self.render()
+            except Exception as e:
+                log.error("Error updating the display: %s", e)
+            self._pushed_at = self.clock()
+
+    def start(self):
+        """Start the render thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._dirty.set()
+
+    def stats(self):
+        return {'frames': self.frames, 'runs': self.runs, 'cells_written': self.cells_written,
+                'coalesced': self.coalesced}
+
+
+async def follow_playback(display, tracker, interval=PROGRESS_INTERVAL):
+    """Keep the display's progress indicator in step with the tracker's prediction; costs no Spotify calls."""
+    while True:
+        if tracker.is_playing():
+            display.progress(tracker.progress_ms(), tracker.playback['item']['duration_ms'])
+        else:
+            display.progress(None, None)
+        await asyncio.sleep(interval)
+
+
+def make_display(kind='console', cols=None, rows=None, refresh_hz=REFRESH_HZ, **options):
+    """A started `RadioDisplay` on the 'console', 'framebuffer' (simulated) or 'lcd' (I2C) backend."""
+    if kind == 'lcd':
+        backend = CharacterLcdBackend(cols or 16, rows or 2, **options)
+    elif kind == 'framebuffer':
+        backend = FramebufferBackend(cols or 16, rows or 2, **options)
+    elif kind == 'console':
+        backend = ConsoleBackend(cols or 160, rows or 1)
+    else:
+        raise ValueError(f"Unknown display: {kind!r}")
+    display = RadioDisplay(backend, refresh_hz=refresh_hz)
+    display.start()
+    return display
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Unix datagram socket the web panel listens on for events from the radio
+EVENTS_SOCKET_FILE = 'radio_events.sock'
+
+# Events kept as shared state and replayed to every new subscriber
+STATE_EVENTS = ('now_playing', 'progress', 'channel')
+
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def now_playing_payload(playback):
+    """The small, display-ready part of a `current_playback()` snapshot."""
+    if not playback or not playback.get('item'):
+        return {'is_playing': False}
+    item = playback['item']
+    images = (item.get('album') or {}).get('images') or []
+    return {
+        'is_playing': playback.get('is_playing', False),
+        'uri': item.get('uri'),
+        'name': item.get('name'),
+        'artists': [artist['name'] for artist in item.get('artists', [])],
+        'duration_ms': item.get('duration_ms'),
+        'progress_ms': playback.get('progress_ms'),
+        'image_url': images[-1]['url'] if images else None,
+    }
+
+
+class EventPublisher:
+    """Fire-and-forget events from the radio to the web panel.
+
+    Publishing never blocks and never fails: if no panel is listening the event is dropped.
+    """
+
+    def __init__(self, socket_path=EVENTS_SOCKET_FILE):
+        self.socket_path = socket_path
+        try:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+        except (OSError, AttributeError):
+            self._socket = None
+        self.dropped = 0
+
+    def publish(self, event, data=None):
+        if self._socket is None:
+            return
+        message = json.dumps({'event': event, 'data': data, 'time': time.time()}).encode()
+        try:
+            self._socket.sendto(message, self.socket_path)
+        except OSError:
+            self.dropped += 1
+
+
+class EventHub:
+    """Receives radio events in the web panel and fans them out to any number of subscribers.
+
+    The latest now-playing/progress/channel state is kept, so a new browser tab is up to
+    date immediately; no subscriber ever causes a Spotify call.
+    """
+
+    def __init__(self, socket_path=EVENTS_SOCKET_FILE):
+        self.socket_path = socket_path
+        self.state = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Bind the socket and start receiving; safe to call more than once."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            try:
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(self.socket_path)
+            except (OSError, AttributeError) as e:
+                log.warning("Radio events unavailable: %s", e)
+                sock = None
+            self._thread = threading.Thread(target=self._receive, args=(sock,), daemon=True)
+            self._thread.start()
+
+    def _receive(self, sock):
+        if sock is None:
+            return
+        while True:
+            try:
+                message = json.loads(sock.recv(65536))
+            except (OSError, ValueError) as e:
+                log.error("Error receiving radio event: %s", e)
+                continue
+            self.publish(message['event'], message.get('data'), message.get('time'))
+
+    def publish(self, event, data=None, at=None):
+        message = {'event': event, 'data': data, 'time': at or time.time()}
+        with self._lock:
+            if event in STATE_EVENTS:
+                self.state[event] = message
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # A stalled client loses events rather than holding up everyone else
+                pass
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            for message in self.state.values():
+                subscriber.put_nowait(message)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+import time
+
+# Each debug/info call site is let through at most once per this many seconds
+RATE_LIMIT_INTERVAL = 10.0
+
+# Warnings and errors are always logged
+RATE_LIMIT_BELOW = logging.WARNING
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets each debug/info call site through at most once per `interval`, so a loop can't flood the log.
+
+    Call sites are told apart by logger and message template (not the formatted
+    message), so they should log with %-style arguments. The next line that gets
+    through says how many were dropped in between. Records at `below` or above, and
+    call sites that pass `extra={'rate_limit': False}` (one line per user action, such
+    as a zap), always get through.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, clock=time.monotonic, below=RATE_LIMIT_BELOW):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self.below = below
+        self._last = {}  # (logger, template) -> [last emitted at, dropped since]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.below or not getattr(record, 'rate_limit', True):
+            return True
+        key = (record.name, record.msg)
+        now = self.clock()
+        with self._lock:
+            state = self._last.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+            dropped = state[1] if state is not None else 0
+            self._last[key] = [now, 0]
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar messages suppressed)"
+        return True
+
+
+def setup_logging(level=None, interval=RATE_LIMIT_INTERVAL):
+    """Log to stderr at `level` (default: the LOG_LEVEL environment variable, else INFO), debug/info rate-limited."""
+    root = logging.getLogger()
+    if root.handlers:
+        return  # Already set up, e.g. by another entry point in the same process
+    level = level or os.getenv('LOG_LEVEL', 'INFO').upper()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(interval))
+    root.addHandler(handler)
+    root.setLevel(level)
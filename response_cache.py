@@ -0,0 +1,103 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from metrics import Counter
+from spotify_scheduler import get_scheduler
+from ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CACHE_REQUESTS = Counter('response_cache_requests', 'Cached Spotify responses asked for, by outcome',
+                                  ('cache', 'result'))
+
+
+class ResponseCache:
+    """Short-lived cache of Spotify responses shared by every web request in the process.
+
+    Concurrent requests for the same key share one upstream call (single flight). With
+    `stale_ttl`, a response older than `ttl` is still served for that much longer while
+    one background call fetches a fresh one (stale-while-revalidate). Entries are keyed
+    by the caller, per user token, and bounded to `maxsize` in LRU order.
+    """
+
+    def __init__(self, name, ttl, stale_ttl=0, maxsize=256):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl + stale_ttl)
+        self._in_flight = {}  # key -> Future of the upstream call
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """The response for `key`, calling `fetch()` only when no usable one is cached or on its way."""
+        value, age = self._entries.get_with_age(key)
+        if age is not None:
+            if age <= self.ttl:
+                RESPONSE_CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            else:
+                RESPONSE_CACHE_REQUESTS.inc(cache=self.name, result='stale')
+                self._revalidate(key, fetch)
+            return value
+
+        future, leader = self._join(key)
+        if not leader:
+            RESPONSE_CACHE_REQUESTS.inc(cache=self.name, result='coalesced')
+            return future.result()
+        RESPONSE_CACHE_REQUESTS.inc(cache=self.name, result='miss')
+        return self._fetch(key, fetch, future)
+
+    def _join(self, key):
+        """The in-flight call for `key`, and whether the caller has to make it."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _fetch(self, key, fetch, future):
+        try:
+            value = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self._entries.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _revalidate(self, key, fetch):
+        future, leader = self._join(key)
+        if not leader:
+            return
+
+        def run():
+            try:
+                self._fetch(key, fetch, future)
+            except Exception as e:
+                log.error("Error refreshing cached %s: %s", self.name, e)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def invalidate(self, key):
+        self._entries.pop(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# What the web panels ask Spotify for, and how long the answers stay good (seconds)
+PLAYBACK = ResponseCache('playback', ttl=2)
+PLAYLIST_ITEMS = ResponseCache('playlist_items', ttl=60, stale_ttl=600)
+CURRENT_USER = ResponseCache('current_user', ttl=3600)
+
+
+def cached_call(cache, token, priority, fn, *args, **kwargs):
+    """`fn(*args, **kwargs)` through the scheduler, answered from `cache` per user `token` when possible."""
+    key = (token, getattr(fn, '__name__', repr(fn)), args, tuple(sorted(kwargs.items())))
+    return cache.get(key, lambda: get_scheduler().call(priority, fn, *args, **kwargs))
@@ -0,0 +1,247 @@
+import array
+import random
+
+# State store key the play history and each channel's place in its shuffle are kept under
+SHUFFLE_STATE_KEY = 'shuffle'
+
+# Number of recently played tracks that are skipped when building a channel's queue
+HISTORY_SIZE = 500
+
+# Tracks handed to Spotify per start_playback
+WINDOW_SIZE = 100
+
+TRACK_PREFIX = 'spotify:track:'
+ID_LENGTH = 22  # Spotify ids are 22 base62 characters
+
+
+def track_id(uri):
+    """The 22-byte id of a `spotify:track:` URI, or None for local files, episodes and the like."""
+    if not uri or not uri.startswith(TRACK_PREFIX) or len(uri) != len(TRACK_PREFIX) + ID_LENGTH:
+        return None
+    return uri[len(TRACK_PREFIX):].encode('ascii')
+
+
+def track_uri(tid):
+    return TRACK_PREFIX + tid.decode('ascii')
+
+
+class PlayHistory:
+    """Ring buffer of the last `size` track ids played, in one fixed-size bytearray."""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self._ring = bytearray(size * ID_LENGTH)
+        self._head = 0  # Slot the next play is written to
+        self._length = 0
+        self._counts = {}  # track id -> times it is in the ring
+
+    def __contains__(self, tid):
+        return tid in self._counts
+
+    def __len__(self):
+        return self._length
+
+    def add(self, tid):
+        start = self._head * ID_LENGTH
+        if self._length == self.size:
+            evicted = bytes(self._ring[start:start + ID_LENGTH])
+            if self._counts[evicted] == 1:
+                del self._counts[evicted]
+            else:
+                self._counts[evicted] -= 1
+        else:
+            self._length += 1
+        self._ring[start:start + ID_LENGTH] = tid
+        self._counts[tid] = self._counts.get(tid, 0) + 1
+        self._head = (self._head + 1) % self.size
+
+    def ids(self):
+        """Track ids, oldest first."""
+        first = (self._head - self._length) % self.size
+        slots = ((first + i) % self.size for i in range(self._length))
+        return [bytes(self._ring[slot * ID_LENGTH:(slot + 1) * ID_LENGTH]) for slot in slots]
+
+
+class ChannelShuffle:
+    """One channel's tracks as fixed-width ids in a single bytes object, plus a shuffled play order.
+
+    `position` is the next index of `order` to hand out; `current` the index playing
+    (or last played), with `resume_ms` set when the channel was left mid-track.
+    """
+
+    def __init__(self, snapshot_id, ids, seed=None, position=0, current=None, resume_ms=None):
+        self.snapshot_id = snapshot_id
+        self._ids = ids
+        self.position = position
+        self.current = current
+        self.resume_ms = resume_ms
+        self.window_end = 0
+        self.shuffle(seed)
+
+    def __len__(self):
+        return len(self._ids) // ID_LENGTH
+
+    def shuffle(self, seed=None):
+        """(Re)build the play order; the seed is all that needs saving to rebuild it later."""
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        order = list(range(len(self)))
+        random.Random(self.seed).shuffle(order)
+        self.order = array.array('I', order)
+
+    def track(self, index):
+        start = self.order[index] * ID_LENGTH
+        return self._ids[start:start + ID_LENGTH]
+
+    def find(self, tid, start, limit):
+        """Index of `tid` in the play order between `start` and `start + limit`, or None."""
+        for index in range(max(start, 0), min(start + limit, len(self))):
+            if self.track(index) == tid:
+                return index
+        return None
+
+    def state(self):
+        return {'snapshot_id': self.snapshot_id, 'seed': self.seed, 'position': self.position,
+                'current': self.current, 'resume_ms': self.resume_ms}
+
+
+class ShuffleEngine:
+    """Local shuffle for the radio's channels, so listeners don't keep hearing the same opening tracks.
+
+    Each channel plays through its own random order, one `start_playback` window of
+    explicit track URIs at a time, skipping anything in the station-wide play history.
+    Leaving a channel remembers the track and position, so coming back resumes it.
+    The history and every channel's place are kept in the `StateStore` across restarts;
+    the track lists themselves are reloaded (see `ChannelPrefetcher`) and only when a
+    playlist changes.
+    """
+
+    def __init__(self, store, history_size=HISTORY_SIZE, window_size=WINDOW_SIZE):
+        self.store = store
+        self.window_size = window_size
+        self.history = PlayHistory(history_size)
+        self.channels = {}  # playlist_uri -> ChannelShuffle
+        self._saved = {}  # playlist_uri -> saved state, for channels whose tracks aren't loaded yet
+
+        self.plays = 0
+        self.repeats = 0
+        self._load()
+
+    def _load(self):
+        state = self.store.get(SHUFFLE_STATE_KEY, {})
+        for tid in state.get('history', []):
+            self.history.add(tid.encode('ascii'))
+        self._saved = state.get('channels', {})
+        self.plays = state.get('plays', 0)
+        self.repeats = state.get('repeats', 0)
+
+    def save(self):
+        channels = dict(self._saved)
+        channels.update((uri, channel.state()) for uri, channel in self.channels.items())
+        self.store.set(SHUFFLE_STATE_KEY, {
+            'history': [tid.decode('ascii') for tid in self.history.ids()],
+            'channels': channels,
+            'plays': self.plays,
+            'repeats': self.repeats,
+        })
+
+    # Track lists
+
+    def has_tracks(self, playlist_uri, snapshot_id=None):
+        channel = self.channels.get(playlist_uri)
+        return channel is not None and (snapshot_id is None or channel.snapshot_id == snapshot_id)
+
+    def load(self, playlist_uri, snapshot_id, uris):
+        """Set a channel's tracks; its saved place is kept as long as the playlist hasn't changed."""
+        ids = b''.join(tid for tid in map(track_id, uris) if tid is not None)
+        saved = self._saved.pop(playlist_uri, None)
+        if saved is not None and saved['snapshot_id'] == snapshot_id:
+            channel = ChannelShuffle(snapshot_id, ids, saved['seed'], saved['position'],
+                                     saved['current'], saved['resume_ms'])
+        else:
+            channel = ChannelShuffle(snapshot_id, ids)
+        self.channels[playlist_uri] = channel
+
+    # Playback
+
+    def next_window(self, playlist_uri):
+        """Track URIs to start the channel with and the position in the first one, or None if unknown."""
+        channel = self.channels.get(playlist_uri)
+        if channel is None or not len(channel):
+            return None
+
+        uris = []
+        position_ms = 0
+        index = channel.position
+        if channel.current is not None and channel.resume_ms is not None:
+            # Pick up the track we left, where we left it
+            uris.append(track_uri(channel.track(channel.current)))
+            position_ms = channel.resume_ms
+            index = channel.current + 1
+        elif index >= len(channel):
+            channel.shuffle()
+            channel.position = index = 0
+            channel.current = None
+
+        window_end = index
+        skipped = []
+        while index < len(channel) and len(uris) < self.window_size:
+            tid = channel.track(index)
+            index += 1
+            if tid in self.history:
+                skipped.append((index, tid))
+            else:
+                uris.append(track_uri(tid))
+                window_end = index
+        if not uris:
+            # Everything left has been played recently; repeat rather than stay silent
+            skipped = skipped[:self.window_size]
+            uris = [track_uri(tid) for _, tid in skipped]
+            window_end = skipped[-1][0]
+        channel.window_end = window_end
+        return uris, position_ms
+
+    def played(self, playlist_uri, uri):
+        """Record that `uri` started playing on the channel."""
+        tid = track_id(uri)
+        if tid is None:
+            return
+        channel = self.channels.get(playlist_uri)
+        if channel is not None:
+            if channel.current is not None and channel.track(channel.current) == tid:
+                # The track we resumed, not a new play
+                channel.resume_ms = None
+                return
+            start = channel.current + 1 if channel.current is not None else channel.position
+            index = channel.find(tid, start, channel.window_end - start)
+            if index is not None:
+                channel.current = index
+                channel.position = index + 1
+                channel.resume_ms = None
+
+        self.plays += 1
+        if tid in self.history:
+            self.repeats += 1
+        self.history.add(tid)
+        self.save()
+
+    def leave(self, playlist_uri, uri, progress_ms):
+        """Remember how far into `uri` the channel got, to resume there next time."""
+        channel = self.channels.get(playlist_uri)
+        tid = track_id(uri)
+        if channel is None or tid is None or channel.current is None or channel.track(channel.current) != tid:
+            return
+        channel.resume_ms = progress_ms
+        self.save()
+
+    def window_exhausted(self, playlist_uri):
+        """True once the last track of the channel's current window is playing."""
+        channel = self.channels.get(playlist_uri)
+        return channel is not None and channel.window_end > 0 and channel.position >= channel.window_end
+
+    def stats(self):
+        return {
+            'plays': self.plays,
+            'repeats': self.repeats,
+            'repeat_rate': round(self.repeats / self.plays, 3) if self.plays else 0.0,
+            'channels_loaded': len(self.channels),
+        }
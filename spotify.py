@@ -1,7 +1,7 @@
-from flask import Flask, request, jsonify, redirect, session, render_template, url_for
+from flask import Flask, Response, request, jsonify, redirect, session, render_template, url_for
 from spotify_integration import SpotifyIntegration
+from playlist_catalog import session_catalog
 import os
-import spotipy
 from dotenv import load_dotenv
 
 # Load environment variables from .env
@@ -58,19 +58,7 @@ def callback():
 
 def get_spotify_client():
     """Retrieve the authenticated Spotify client, refresh token if needed."""
-    token_info = session.get('token_info', None)
-    if not token_info:
-        return None
-
-    # Check if token is expired and refresh it if necessary
-    if spotify.is_token_expired(token_info):
-        print("Token expired, refreshing...")
-        token_info = spotify.refresh_access_token(token_info['refresh_token'])
-        session['token_info'] = token_info
-
-    access_token = token_info['access_token']
-    sp = spotipy.Spotify(auth=access_token)
-    return sp
+    return spotify.get_client()
 
 @app.route('/get_playlists', methods=['GET'])
 def get_playlists():
@@ -78,15 +66,22 @@ def get_playlists():
     try:
         sp = get_spotify_client()
         if sp:
-            playlists = sp.current_user_playlists(limit=50)  # Fetch the user's playlists
+            catalog = session_catalog(sp, session)
+            playlists = catalog.get(sp)  # Served from the local catalogue, synced in the background
+            if request.if_none_match.contains(catalog.etag):
+                return Response(status=304, headers={'ETag': f'"{catalog.etag}"'})
+
             playlist_data = []
-            for playlist in playlists['items']:
+            for playlist in playlists:
                 playlist_data.append({
                     'name': playlist['name'],
                     'uri': playlist['uri'],
                     'image_url': playlist['images'][0]['url'] if playlist['images'] else None  # Fetch the first image
                 })
-            return jsonify(playlist_data), 200
+            response = jsonify(playlist_data)
+            response.set_etag(catalog.etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response, 200
         else:
             print("Error: Unable to fetch playlists. User not authenticated.")
             return jsonify({"error": "Unable to fetch playlists. Please login to Spotify."}), 401
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter
+
+log = logging.getLogger(__name__)
+
+# Refresh tokens this many seconds before they expire
+REFRESH_MARGIN = 300
+
+# Seconds to wait before retrying a failed background refresh
+REFRESH_RETRY_DELAY = 30
+
+# Number of per-user clients kept around for the web panels
+MAX_CACHED_CLIENTS = 32
+
+TOKEN_REFRESHES = Counter('spotify_token_refreshes', 'Spotify access token refreshes', ('source',))
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_http_session():
+    """One keep-alive `requests.Session` shared by every Spotify client in the process."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def make_client(auth=None, auth_manager=None):
+    """Build a spotipy client that reuses the shared connection pool.
+
+    spotipy's own retries on 429/5xx are turned off: they would sleep inside a call
+    without the scheduler knowing, so `spotify_scheduler` handles them instead.
+    """
+    return spotipy.Spotify(auth=auth, auth_manager=auth_manager, requests_session=get_http_session(),
+                           status_retries=0)
+
+
+def token_needs_refresh(token_info, margin=REFRESH_MARGIN):
+    return token_info['expires_at'] - time.time() < margin
+
+
+def refresh_if_needed(sp_oauth, token_info, margin=REFRESH_MARGIN):
+    """Refresh `token_info` a little before it expires rather than after."""
+    if token_needs_refresh(token_info, margin):
+        log.info("Token about to expire, refreshing...")
+        token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
+        TOKEN_REFRESHES.inc(source='session')
+    return token_info
+
+
+def client_for_token(access_token):
+    """Cached client for a web session's access token."""
+    with _clients_lock:
+        client = _clients.get(access_token)
+        if client is None:
+            client = make_client(auth=access_token)
+            _clients[access_token] = client
+            if len(_clients) > MAX_CACHED_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(access_token)
+        return client
+
+
+def session_client(sp_oauth, session):
+    """Client for the logged-in Flask session, refreshing (and storing) its token when close to expiry."""
+    token_info = session.get('token_info')
+    if not token_info:
+        return None
+    refreshed = refresh_if_needed(sp_oauth, token_info)
+    if refreshed is not token_info:
+        session['token_info'] = refreshed
+    return client_for_token(refreshed['access_token'])
+
+
+class SpotifyClientProvider:
+    """Owns the radio's OAuth token, refreshes it in the background and hands out one shared client.
+
+    The provider doubles as the client's auth manager, so every request picks up the
+    current token without a network round-trip or an expiry check of its own.
+    """
+
+    def __init__(self, sp_oauth, refresh_margin=REFRESH_MARGIN):
+        self.sp_oauth = sp_oauth
+        self.refresh_margin = refresh_margin
+        self.token_info = None
+        self.refresh_count = 0
+        self._client = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def cached_token(self):
+        """The token in the cache file, as is: no network, even when it has expired."""
+        return self.sp_oauth.cache_handler.get_cached_token()
+
+    def load_token(self):
+        """Load the token from the cache, falling back to the interactive OAuth flow.
+
+        An expired cached token is loaded anyway; the refresh thread (or the first
+        request) renews it, so startup never waits on the network.
+        """
+        with self._lock:
+            if self.token_info is None:
+                token_info = self.cached_token()
+                if not token_info:
+                    token_info = self.sp_oauth.get_access_token()
+                self.token_info = token_info
+            return self.token_info
+
+    def refresh(self):
+        with self._lock:
+            self.token_info = self.sp_oauth.refresh_access_token(self.token_info['refresh_token'])
+            self.refresh_count += 1
+            TOKEN_REFRESHES.inc(source='radio')
+            log.info("Spotify token refreshed.")
+            return self.token_info
+
+    # Called by spotipy for every request
+    def get_access_token(self, as_dict=False):
+        token_info = self.token_info or self.load_token()
+        if self.sp_oauth.is_token_expired(token_info):
+            # The background refresh fell behind; don't send a dead token
+            token_info = self.refresh()
+        return token_info if as_dict else token_info['access_token']
+
+    def get_client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = make_client(auth_manager=self)
+            return self._client
+
+    def start(self):
+        """Start the background refresh thread."""
+        self.load_token()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            delay = self.token_info['expires_at'] - time.time() - self.refresh_margin
+            if delay > 0 and self._stop.wait(delay):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error("Error refreshing Spotify token: %s", e)
+                self._stop.wait(REFRESH_RETRY_DELAY)
@@ -1,8 +1,9 @@
 # spotify_integration.py
-import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from flask import session
 
+from spotify_client import refresh_if_needed, session_client
+
 class SpotifyIntegration:
     def __init__(self, client_id, client_secret, redirect_uri):
         self.sp_oauth = SpotifyOAuth(client_id=client_id,
@@ -17,8 +18,10 @@ class SpotifyIntegration:
         return self.sp_oauth.get_access_token(code)
 
     def refresh_token_if_needed(self):
-        token_info = session.get('token_info')
-        if self.sp_oauth.is_token_expired(token_info):
-            token_info = self.sp_oauth.refresh_access_token(token_info['refresh_token'])
-            session['token_info'] = token_info
+        token_info = refresh_if_needed(self.sp_oauth, session.get('token_info'))
+        session['token_info'] = token_info
         return token_info['access_token']
+
+    def get_client(self):
+        """Shared, connection-pooled client for the logged-in session (None if not logged in)."""
+        return session_client(self.sp_oauth, session)
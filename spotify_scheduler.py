@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import spotipy
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+USER = 0  # Zaps, play/pause, station breaks
+MONITOR = 1  # Playback snapshots
+BACKGROUND = 2  # Prefetching, playlist sync
+
+# Token bucket: sustained calls per second and burst size
+RATE = 3.0
+BURST = 10
+
+# Tokens only user calls may use, so background work can never starve a zap
+USER_RESERVE = 3
+
+# Retries for rate-limited (429) and server error (5xx) responses
+MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 1.0  # seconds, when Spotify doesn't send Retry-After
+MAX_RETRY_AFTER = 60.0
+
+WORKERS = 4
+
+PRIORITY_NAMES = {USER: 'user', MONITOR: 'monitor', BACKGROUND: 'background'}
+
+SPOTIFY_CALL_SECONDS = Histogram('spotify_call_seconds', 'Duration of Spotify API calls', ('endpoint',))
+SPOTIFY_CALL_ERRORS = Counter('spotify_call_errors', 'Failed Spotify API calls', ('endpoint', 'status'))
+SPOTIFY_QUEUE_SECONDS = Histogram('spotify_queue_seconds', 'Time Spotify calls wait in the scheduler', ('priority',))
+SPOTIFY_THROTTLED = Counter('spotify_throttled', 'Rate-limited (429) Spotify responses')
+
+
+def retry_after(exception):
+    """Seconds to back off after a 429, from the Retry-After header when there is one."""
+    headers = getattr(exception, 'headers', None) or {}
+    try:
+        return min(float(headers.get('Retry-After')), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class SpotifyScheduler:
+    """Central gate for Spotify calls with a token-bucket budget, Retry-After handling and priorities.
+
+    Calls wait in a priority queue; the most urgent runnable one goes first whenever a
+    token is available. The last `USER_RESERVE` tokens are kept for user calls. After a
+    429 every call waits out Retry-After and the throttled call is retried in its
+    original place. `serial` calls run one at a time in submission order, so playback
+    changes reach Spotify in the order they were made.
+
+    Calls carry an `owner` (a station, when one process runs several). Within a priority
+    class owners take turns (start-time fair queueing), so a busy station can't use up
+    the budget of the others, and each owner has its own serial lane.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, user_reserve=USER_RESERVE, workers=WORKERS, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.user_reserve = user_reserve
+        self.clock = clock
+        self._tokens = float(burst)
+        self._refilled_at = clock()
+        self._blocked_until = 0.0
+        self._queue = []  # heap of (priority, tag, seq, item)
+        self._seq = itertools.count()
+        self._virtual_time = 0  # Tag of the last call started
+        self._owner_tags = {}  # owner -> tag of its last queued call
+        self._serial_lanes = {}  # owner -> serial call holding its lane, until it has finished
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+        self.calls = {USER: 0, MONITOR: 0, BACKGROUND: 0}
+        self.throttled = 0
+
+    # Submitting calls
+
+    def submit(self, priority, fn, *args, serial=False, owner=None, **kwargs):
+        """Queue `fn(*args, **kwargs)`; returns a `concurrent.futures.Future` (cancel it to drop the call)."""
+        future = Future()
+        item = {'fn': fn, 'args': args, 'kwargs': kwargs, 'future': future, 'owner': owner,
+                'priority': priority, 'serial': serial, 'attempt': 0, 'not_before': 0.0,
+                'submitted_at': time.perf_counter()}
+        with self._cond:
+            # An owner's calls are spaced out in tag order, starting no earlier than now
+            tag = max(self._owner_tags.get(owner, 0), self._virtual_time) + 1
+            self._owner_tags[owner] = tag
+            item['tag'] = tag
+            heapq.heappush(self._queue, (priority, tag, next(self._seq), item))
+            self._cond.notify()
+        return future
+
+    def call(self, priority, fn, *args, **kwargs):
+        """Blocking call through the scheduler, for threads such as Flask request handlers."""
+        return self.submit(priority, fn, *args, **kwargs).result()
+
+    async def run(self, priority, fn, *args, **kwargs):
+        """Awaitable call through the scheduler; cancelling the task drops a call that hasn't started."""
+        return await asyncio.wrap_future(self.submit(priority, fn, *args, **kwargs))
+
+    # Budget
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _next_runnable(self):
+        """Pop the most urgent item that may run now; returns (item, wait) with one of them None."""
+        now = self.clock()
+        if now < self._blocked_until:
+            return None, self._blocked_until - now
+        self._refill(now)
+
+        skipped = []
+        found = None
+        found_entry = None
+        wait = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            item = entry[3]
+            if item['future'].cancelled():
+                continue
+            if item['not_before'] > now:
+                # Waiting to be retried; serial calls behind it keep waiting too
+                wait = min(wait or float('inf'), item['not_before'] - now)
+                skipped.append(entry)
+                continue
+            if item['serial'] and self._serial_lanes.get(item['owner']) not in (None, item):
+                skipped.append(entry)
+                continue
+            found, found_entry = item, entry
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        if found is None:
+            return None, wait
+
+        needed = 1 if found['priority'] == USER else 1 + self.user_reserve
+        if self._tokens < needed:
+            heapq.heappush(self._queue, found_entry)  # Keeps its place in line
+            return None, (needed - self._tokens) / self.rate
+        self._tokens -= 1
+        self._virtual_time = max(self._virtual_time, found['tag'])
+        if found['serial']:
+            self._serial_lanes[found['owner']] = found
+        return found, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    item, wait = self._next_runnable()
+                    if item is not None:
+                        break
+                    self._cond.wait(wait)
+            try:
+                if item['attempt'] == 0 and not item['future'].set_running_or_notify_cancel():
+                    continue
+                self._execute(item)
+            finally:
+                # A serial call being retried keeps the lane, so later ones can't overtake it
+                if item['serial'] and item['future'].done():
+                    with self._cond:
+                        del self._serial_lanes[item['owner']]
+                        self._cond.notify_all()
+
+    def _execute(self, item):
+        endpoint = getattr(item['fn'], '__name__', 'unknown')
+        started = time.perf_counter()
+        if item['attempt'] == 0:
+            SPOTIFY_QUEUE_SECONDS.observe(started - item['submitted_at'], priority=PRIORITY_NAMES[item['priority']])
+        try:
+            try:
+                result = item['fn'](*item['args'], **item['kwargs'])
+            finally:
+                SPOTIFY_CALL_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+        except spotipy.SpotifyException as e:
+            SPOTIFY_CALL_ERRORS.inc(endpoint=endpoint, status=e.http_status)
+            if (e.http_status == 429 or e.http_status >= 500) and item['attempt'] < MAX_RETRIES:
+                self._retry(item, e)
+                return
+            item['future'].set_exception(e)
+        except BaseException as e:
+            SPOTIFY_CALL_ERRORS.inc(endpoint=endpoint, status='error')
+            item['future'].set_exception(e)
+        else:
+            self.calls[item['priority']] += 1
+            item['future'].set_result(result)
+
+    def _retry(self, item, exception):
+        now = self.clock()
+        if exception.http_status == 429:
+            delay = retry_after(exception)
+            self.throttled += 1
+            SPOTIFY_THROTTLED.inc()
+            log.warning("Rate limited by Spotify, backing off for %.1f seconds...", delay)
+        else:
+            delay = DEFAULT_RETRY_AFTER * 2 ** item['attempt']
+        item['attempt'] += 1
+        item['not_before'] = now + delay
+        with self._cond:
+            # A 429 applies to the whole app, so every call waits; a 5xx only delays this one
+            if exception.http_status == 429:
+                self._blocked_until = max(self._blocked_until, now + delay)
+            # Retried calls go back in front of their priority class
+            heapq.heappush(self._queue, (item['priority'], item['tag'], -next(self._seq), item))
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'tokens': round(self._tokens, 2),
+                'calls': dict(self.calls),
+                'throttled': self.throttled,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """The process-wide scheduler every Spotify call goes through."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SpotifyScheduler()
+        return _scheduler
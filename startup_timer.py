@@ -0,0 +1,28 @@
+import logging
+import time
+
+from metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Histogram('startup_seconds', 'Time from process start to each startup milestone', ('milestone',),
+                            buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0, 10.0))
+
+
+class StartupTimer:
+    """Records how long after `started_at` each startup milestone was reached, for one report line."""
+
+    def __init__(self, started_at=None, clock=time.perf_counter):
+        self.clock = clock
+        self.started_at = clock() if started_at is None else started_at
+        self.milestones = []  # (name, seconds since start)
+
+    def mark(self, name):
+        elapsed = self.clock() - self.started_at
+        self.milestones.append((name, elapsed))
+        STARTUP_SECONDS.observe(elapsed, milestone=name)
+        return elapsed
+
+    def report(self):
+        """Log the milestones, e.g. "Startup: imports 180 ms, station 210 ms, keys 260 ms"."""
+        log.info("Startup: %s", ', '.join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in self.milestones))
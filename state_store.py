@@ -0,0 +1,183 @@
+import json
+import logging
+import threading
+import time
+
+from command_bus import DB_FILE, connect
+
+log = logging.getLogger(__name__)
+
+# Queued writes are committed together at most this often (seconds)
+FLUSH_INTERVAL = 2.0
+
+# ...or as soon as this many are waiting
+MAX_BATCH = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS play_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    track_uri TEXT NOT NULL,
+    track_name TEXT,
+    channel_uri TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    trigger_latency_ms REAL
+);
+CREATE INDEX IF NOT EXISTS play_log_started_at ON play_log (started_at);
+CREATE INDEX IF NOT EXISTS play_log_open ON play_log (ended_at) WHERE ended_at IS NULL;
+CREATE TABLE IF NOT EXISTS breaks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command_id INTEGER,
+    command TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    gap_ms REAL,
+    returncode INTEGER
+);
+CREATE INDEX IF NOT EXISTS breaks_started_at ON breaks (started_at);
+CREATE INDEX IF NOT EXISTS breaks_command_id ON breaks (command_id);
+"""
+
+
+class StateStore:
+    """Radio state and history in the shared SQLite database, next to the command queue.
+
+    Holds small key/value state (the current channel, the shuffle), the play log and the
+    station-break history. The radio's writes are queued and committed in batches by a
+    background thread, so the event loop never waits on the disk; reads, from either
+    the radio or the web panel, go straight to the database.
+    """
+
+    def __init__(self, db_path=DB_FILE, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._local = threading.local()
+        self._pending = []  # (sql, params), in order
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn().executescript(SCHEMA)
+
+        self.flushes = 0
+        self.writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    # Batched writes
+
+    def write(self, sql, params=()):
+        """Queue a write; it is committed with the next batch."""
+        with self._lock:
+            self._pending.append((sql, params))
+            if len(self._pending) >= self.max_batch:
+                self._wake.set()
+
+    def flush(self):
+        """Commit every queued write in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, params in pending:
+                    conn.execute(sql, params)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self.flushes += 1
+            self.writes += len(pending)
+
+    def start(self):
+        """Start the background thread committing queued writes."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread and commit whatever is still queued."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Error writing radio state: %s", e)
+
+    # Key/value state
+
+    def get(self, key, default=None):
+        row = self._conn().execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row['value']) if row else default
+
+    def set(self, key, value):
+        self.write('INSERT INTO state (key, value, updated_at) VALUES (?, ?, ?) '
+                   'ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                   (key, json.dumps(value), time.time()))
+
+    # Play log
+
+    def track_started(self, track_uri, track_name=None, channel_uri=None, started_at=None):
+        """Log a new track, ending whichever one was playing before."""
+        started_at = started_at or time.time()
+        self.write('UPDATE play_log SET ended_at = ? WHERE ended_at IS NULL', (started_at,))
+        self.write('INSERT INTO play_log (track_uri, track_name, channel_uri, started_at) VALUES (?, ?, ?, ?)',
+                   (track_uri, track_name, channel_uri, started_at))
+
+    def track_triggered(self, latency_ms):
+        """Record how late the pre-end trigger fired for the track playing now."""
+        self.write('UPDATE play_log SET trigger_latency_ms = ? WHERE ended_at IS NULL', (latency_ms,))
+
+    def close_plays(self, ended_at=None):
+        """End the open play log entry, e.g. one left behind by a radio that was stopped."""
+        self.write('UPDATE play_log SET ended_at = ? WHERE ended_at IS NULL', (ended_at or time.time(),))
+
+    def plays_since(self, since, limit=500):
+        """Play log entries started after `since` (epoch seconds), newest first."""
+        rows = self._conn().execute(
+            'SELECT * FROM play_log WHERE started_at >= ? ORDER BY started_at DESC LIMIT ?',
+            (since, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def recent_plays(self, seconds=3600, limit=500):
+        """What played in the last `seconds`."""
+        return self.plays_since(time.time() - seconds, limit)
+
+    # Station breaks
+
+    def break_started(self, command_id, command):
+        self.write('INSERT INTO breaks (command_id, command, started_at) VALUES (?, ?, ?)',
+                   (command_id, command, time.time()))
+
+    def break_finished(self, command_id, returncode, gap_ms=None):
+        self.write('UPDATE breaks SET ended_at = ?, returncode = ?, gap_ms = ? '
+                   'WHERE id = (SELECT max(id) FROM breaks WHERE command_id = ?)',
+                   (time.time(), returncode, gap_ms, command_id))
+
+    def recent_breaks(self, limit=20):
+        rows = self._conn().execute('SELECT * FROM breaks ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [dict(row) for row in rows]
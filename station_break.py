@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import time
+
+from command_executor import CommandExecutor
+from metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+# Start resuming Spotify this long before the jingle ends, so the music comes in on its tail
+RESUME_LEAD_MS = 250
+
+JINGLE_GAP_SECONDS = Histogram('jingle_gap_seconds', 'Jingle end to music resume (negative when they overlap)',
+                               buckets=(-0.5, -0.25, -0.1, -0.05, 0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+
+class StationBreakWorker:
+    """Runs station breaks (pause, jingle, resume, command) one at a time as an event loop task.
+
+    Jingles come pre-decoded from a `JingleBank`. Spotify is resumed `resume_lead_ms`
+    before the jingle ends so the two overlap; the command then goes to the
+    `CommandExecutor` as its own task, so it can never hold up playback, and its
+    output is published line by line as 'command_output' events. `pause_playback()` and
+    `resume_playback(snapshot)` are coroutine functions; whatever the first returns
+    (where playback was) is handed to the second, so it can resume in place.
+    """
+
+    def __init__(self, jingle_bank, pause_playback, resume_playback, display,
+                 resume_lead_ms=RESUME_LEAD_MS, executor=None, publish=None):
+        self.jingle_bank = jingle_bank
+        self.pause_playback = pause_playback
+        self.resume_playback = resume_playback
+        self.display = display
+        self.resume_lead_ms = resume_lead_ms
+        self.executor = executor or CommandExecutor()
+        self.publish = publish or (lambda event, data=None: None)  # publish(event, data) for the web panel
+        self._queue = None  # asyncio.Queue, created on the loop at first use
+        self.gaps_ms = []  # Jingle end to music resume, per break (negative when they overlap)
+
+    def submit(self, command, on_done=None, command_id=None):
+        """Queue a station break for `command`; returns immediately.
+
+        `on_done(returncode, output)` is called (in an executor) once the command has
+        finished; returncode is None if the break failed before the command could run.
+        """
+        self.queue.put_nowait((command, on_done, command_id))
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def run(self):
+        while True:
+            command, on_done, command_id = await self.queue.get()
+            try:
+                await self._station_break(command, on_done, command_id)
+            except Exception as e:
+                log.error("Error during jingle/command execution: %s", e)
+                await self._done(on_done, None, str(e))
+
+    async def _station_break(self, command, on_done, command_id=None):
+        if self.jingle_bank is None:
+            # No jingles on this station's device: playback carries on and only the command runs
+            self.display(f"Executing command: {command}")
+            asyncio.ensure_future(self._execute(command, on_done, command_id))
+            return
+
+        log.info("Pausing Spotify playback for jingle.")
+        snapshot = await self.pause_playback()
+
+        # Normally a dictionary lookup; only a clip evicted from the bank has to be decoded
+        path, sound = await asyncio.get_running_loop().run_in_executor(None, self.jingle_bank.next)
+        if sound is not None:
+            log.info("Playing jingle: %s", path)
+            self.publish('jingle_start', {'jingle': os.path.basename(path), 'command': command})
+            jingle_end = await self._play_jingle(sound)
+            self.publish('jingle_stop', {'jingle': os.path.basename(path)})
+        else:
+            log.warning("No jingles found in %s", self.jingle_bank.directory)
+            jingle_end = time.monotonic()
+
+        log.info("Resuming Spotify playback.")
+        await self.resume_playback(snapshot)
+        gap_ms = (time.monotonic() - jingle_end) * 1000
+        self.gaps_ms.append(gap_ms)
+        JINGLE_GAP_SECONDS.observe(gap_ms / 1000)
+        log.info("Music resumed %.0f ms after the jingle end.", gap_ms)
+
+        self.display(f"Executing command: {command}")
+        asyncio.ensure_future(self._execute(command, on_done, command_id))
+
+    async def _play_jingle(self, sound):
+        """Start the jingle and return once it is time to resume; returns the jingle's end time."""
+        started = time.monotonic()
+        sound.play()
+        jingle_end = started + sound.get_length()
+        await asyncio.sleep(max(jingle_end - self.resume_lead_ms / 1000 - time.monotonic(), 0))
+        return jingle_end
+
+    async def _execute(self, command, on_done, command_id=None):
+        def on_output(stream, line):
+            self.publish('command_output', {'id': command_id, 'stream': stream, 'line': line})
+
+        try:
+            returncode, output = await self.executor.run(command, on_output)
+        except Exception as e:
+            log.error("Error running command %r: %s", command, e)
+            returncode, output = None, str(e)
+        await self._done(on_done, returncode, output)
+
+    @staticmethod
+    async def _done(on_done, returncode, output):
+        if on_done is not None:
+            await asyncio.get_running_loop().run_in_executor(None, on_done, returncode, output)
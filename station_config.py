@@ -0,0 +1,78 @@
+"""Configuration of the stations run by `station_manager.py`, and where each keeps its files.
+
+Kept free of the radio's own dependencies, so the web panel can read it too.
+"""
+import json
+import os
+import re
+
+# Station list: [{"name": "cafe", "device": "Kitchen speaker", "crossfade": 5}, {"name": "studio", "jingles": "songs"}]
+# Optional per station: device (name), jingles (folder), lead_ms (station breaks start this long before the
+# next track) and crossfade (seconds, as set in the station's Spotify player)
+STATIONS_FILE = 'stations.json'
+
+# Jingles are played on this server's sound card, so only a station whose Spotify device is this server's
+# output can have them; the others run their commands at the track boundary without pausing the music
+
+# Each station's files live in a folder of its own under this one
+STATIONS_DIR = 'stations'
+
+# Station names end up in paths and URLs
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class StationConfig:
+    """Where a station keeps its files, which device and jingles it uses, and its track-boundary timing."""
+
+    def __init__(self, name, device_name=None, jingle_dir=None, stations_dir=STATIONS_DIR,
+                 trigger_lead_ms=None, crossfade_ms=0):
+        if not NAME_PATTERN.match(name or ''):
+            raise ValueError(f"Invalid station name: {name!r}")
+        self.name = name
+        self.device_name = device_name
+        self.jingle_dir = jingle_dir
+        self.trigger_lead_ms = trigger_lead_ms
+        self.crossfade_ms = crossfade_ms
+        self.directory = os.path.join(stations_dir, name)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @property
+    def playlists_file(self):
+        return self.path('playlists.json')
+
+    @property
+    def db_file(self):
+        return self.path('radio.db')
+
+    @property
+    def command_socket(self):
+        return self.path('radio_commands.sock')
+
+    @property
+    def events_socket(self):
+        return self.path('radio_events.sock')
+
+    @property
+    def token_cache(self):
+        return self.path('.cache')
+
+
+def load_stations(path=STATIONS_FILE, stations_dir=STATIONS_DIR):
+    """The configured stations, by name; an empty dict when there is no stations file."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        entries = json.load(file)
+    stations = {}
+    for entry in entries:
+        config = StationConfig(entry['name'], entry.get('device'), entry.get('jingles'), stations_dir,
+                               entry.get('lead_ms'), int(entry.get('crossfade', 0) * 1000))
+        if config.name in stations:
+            raise ValueError(f"Duplicate station name: {config.name!r}")
+        stations[config.name] = config
+    local = [config.name for config in stations.values() if config.jingle_dir]
+    if len(local) > 1:
+        raise ValueError(f"Only one station can play jingles on this server's sound card, not {', '.join(local)}")
+    return stations
@@ -0,0 +1,183 @@
+"""Many radio stations in one process: one event loop, one Spotify scheduler and one connection pool.
+
+    python station_manager.py                  # run every station in stations.json
+    python station_manager.py --login cafe     # log in the Spotify account of station "cafe"
+
+Each station has its own Spotify account, playback device, channel list, command
+queue and state, all kept in `stations/<name>/`. Stations take turns for the shared
+rate budget, so a busy one can't starve the others, and their commands share one
+bounded pool of workers (templates from commands.json).
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from spotipy.oauth2 import SpotifyOAuth
+
+from spotify_client import SpotifyClientProvider
+from channel_registry import ChannelRegistry
+from jingle_bank import JingleBank
+from command_bus import CommandQueue
+from command_executor import CommandExecutor
+from radio_events import EventPublisher
+from radio_core import RadioStation
+from shuffle_engine import ShuffleEngine
+from state_store import StateStore
+from radio_logging import setup_logging
+from station_config import STATIONS_FILE, load_stations
+
+log = logging.getLogger(__name__)
+
+# Seconds before a station that crashed is started again
+RESTART_DELAY = 30
+
+SCOPE = "user-library-read user-read-playback-state user-modify-playback-state playlist-read-private"
+
+
+def make_oauth(config):
+    """OAuth for a station's own Spotify account, with the token cached in its folder."""
+    return SpotifyOAuth(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'),
+                        redirect_uri=os.getenv('SPOTIPY_REDIRECT_URI'), scope=SCOPE,
+                        cache_path=config.token_cache, open_browser=False)
+
+
+class Station:
+    """One station's token, command queue, state and `RadioStation`, sharing the process with others."""
+
+    def __init__(self, config, jingle_bank, resume_lead_ms=None, executor=None):
+        self.config = config
+        os.makedirs(config.directory, exist_ok=True)
+        self.client_provider = SpotifyClientProvider(make_oauth(config))
+        self.channel_registry = ChannelRegistry(config.playlists_file)
+        self.command_queue = CommandQueue(config.db_file, config.command_socket)
+        self.store = StateStore(config.db_file)
+        self.events = EventPublisher(config.events_socket)
+        self.shuffle = ShuffleEngine(self.store)
+        self.jingle_bank = jingle_bank
+        self.resume_lead_ms = resume_lead_ms
+        self.executor = executor
+        self.radio = None
+
+    @property
+    def name(self):
+        return self.config.name
+
+    def display(self, message):
+        log.info("[%s] %s", self.name, message)
+
+    def start(self):
+        """Load the cached token and start the background threads. Returns False without a token."""
+        if not self.client_provider.cached_token():
+            log.error("Station %s has no Spotify token; log in with --login %s", self.name, self.name)
+            return False
+        self.client_provider.start()
+        self.channel_registry.start_watching()
+        self.store.start()
+        self.radio = RadioStation(self.client_provider.get_client(), self.channel_registry, self.command_queue,
+                                  self.events, self.jingle_bank, self.display, resume_lead_ms=self.resume_lead_ms,
+                                  shuffle=self.shuffle, store=self.store, name=self.name,
+                                  device_name=self.config.device_name, trigger_lead_ms=self.config.trigger_lead_ms,
+                                  crossfade_ms=self.config.crossfade_ms, executor=self.executor)
+        return True
+
+    def stop(self):
+        self.client_provider.stop()
+        self.channel_registry.stop_watching()
+        self.store.stop()
+
+
+class StationManager:
+    """Runs every station as tasks on one event loop, through the process-wide `SpotifyScheduler`.
+
+    Only the station playing on this server's own output has jingles; the others' breaks
+    leave the music playing and just run the command. The command executor is shared by
+    all of them, so its worker limit holds for the whole process. A station that
+    crashes is logged and started again after `RESTART_DELAY`, without taking the
+    others down.
+    """
+
+    def __init__(self, configs, resume_lead_ms=None, restart_delay=RESTART_DELAY):
+        self.restart_delay = restart_delay
+        self.jingle_banks = {}
+        self.executor = CommandExecutor()
+        self.stations = {}
+        for config in configs:
+            if config.jingle_dir and config.jingle_dir not in self.jingle_banks:
+                self.jingle_banks[config.jingle_dir] = JingleBank(config.jingle_dir)
+            self.stations[config.name] = Station(config, self.jingle_banks.get(config.jingle_dir), resume_lead_ms,
+                                                  self.executor)
+        self.running = {}
+
+    def start(self):
+        """Decode the jingles and start every station that has a token. Returns the started ones."""
+        for jingle_bank in self.jingle_banks.values():
+            jingle_bank.load()
+        self.running = {name: station for name, station in self.stations.items() if station.start()}
+        return list(self.running)
+
+    def stop(self):
+        for station in self.running.values():
+            station.stop()
+
+    async def run_station(self, station):
+        while True:
+            try:
+                await station.radio.run()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Station %s crashed, restarting in %d seconds", station.name, self.restart_delay)
+                await asyncio.sleep(self.restart_delay)
+
+    async def run(self):
+        """Run the started stations until cancelled."""
+        log.info("Running %d station(s): %s", len(self.running), ', '.join(self.running))
+        await asyncio.gather(*(self.run_station(station) for station in self.running.values()))
+
+
+def login(config):
+    """Interactive Spotify login for one station; the token is cached in the station's folder."""
+    os.makedirs(config.directory, exist_ok=True)
+    sp_oauth = make_oauth(config)
+    print(f"Log in with the Spotify account of station {config.name}:")
+    print(sp_oauth.get_authorize_url())
+    response = input("Paste the URL you were redirected to: ")
+    sp_oauth.get_access_token(sp_oauth.parse_response_code(response), as_dict=False)
+    print(f"Token saved to {config.token_cache}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default=STATIONS_FILE, help='station list (JSON)')
+    parser.add_argument('--login', metavar='STATION', help='log in the Spotify account of a station and exit')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    setup_logging()
+    stations = load_stations(args.config)
+    if not stations:
+        parser.error(f"No stations configured in {args.config}")
+
+    if args.login:
+        if args.login not in stations:
+            parser.error(f"Unknown station: {args.login}")
+        login(stations[args.login])
+        return
+
+    resume_lead_ms = int(os.getenv('JINGLE_RESUME_LEAD_MS', 250))
+    manager = StationManager(stations.values(), resume_lead_ms=resume_lead_ms)
+    if not manager.start():
+        parser.error("No station has a Spotify token yet")
+    try:
+        asyncio.run(manager.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+
+
+if __name__ == '__main__':
+    main()
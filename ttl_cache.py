@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire `ttl` seconds after they were stored."""
+
+    def __init__(self, maxsize=64, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        return self.get_with_age(key, default)[0]
+
+    def get_with_age(self, key, default=None):
+        """(value, seconds since it was stored), or (default, None) if absent or expired; one lookup."""
+        with self._lock:
+            entry = self._data.get(key)
+            age = None if entry is None else self.clock() - entry[0]
+            if entry is None or age > self.ttl:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1], age
+
+    def age(self, key):
+        """Seconds since `key` was stored (None if absent), ignoring expiry."""
+        with self._lock:
+            entry = self._data.get(key)
+            return None if entry is None else self.clock() - entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self.clock(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)